@@ -0,0 +1,286 @@
+# src/answer_table.py
+# ==============================================
+# Purpose: Precomputed answers for frequent question templates.
+#          An offline job mines the most frequent (normalised) questions from
+#          the query logs and the validation set, generates an answer for
+#          every (template, report uid) pair in batches and stores them in an
+#          indexed SQLite table. Online, a matching (question, uid) is answered
+#          from memory; anything else falls back to live RAG.
+# ==============================================
+
+import os
+import re
+import sys
+import csv
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import Counter
+from datetime import datetime
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.emb_store import uids_path_for
+
+# =========================================================
+# 🧩 CONFIGURATION SECTION
+# =========================================================
+
+DB_PATH = "models/answer_table.sqlite"
+TEXT_PATH = "models/texts.txt"
+VALIDATION_CSV = "data/validation_questions.csv"
+LOG_PATHS = ["logs/logs.csv", "app/logs/answers.log"]
+
+# A normalised question must be asked at least this often to be precomputed
+MIN_TEMPLATE_COUNT = 20
+MAX_TEMPLATES = 10
+
+# Report chunks used as context for a precomputed answer
+CONTEXT_CHUNKS = 3
+
+# Seconds between checks of texts.txt for re-embedding
+STALE_CHECK_SECONDS = 1.0
+
+
+# =========================================================
+# 🔎 TEMPLATE MINING
+# =========================================================
+
+def normalize_question(q):
+    """Lower-case, drop punctuation and collapse whitespace."""
+    q = re.sub(r"[^\w\s]", " ", str(q).lower())
+    return re.sub(r"\s+", " ", q).strip()
+
+
+def _logged_queries(path):
+    if not os.path.exists(path):
+        return []
+    if path.endswith(".csv"):
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            return [row.get("query", "") for row in csv.DictReader(f)]
+    queries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                queries.append(json.loads(line).get("query", ""))
+            except json.JSONDecodeError:
+                continue
+    return queries
+
+
+def mine_templates(validation_csv=VALIDATION_CSV, log_paths=LOG_PATHS,
+                   min_count=MIN_TEMPLATE_COUNT, max_templates=MAX_TEMPLATES):
+    """Return [(template, count)] of the most frequent normalised questions."""
+    counts = Counter()
+    if os.path.exists(validation_csv):
+        with open(validation_csv, "r", encoding="utf-8", newline="") as f:
+            counts.update(normalize_question(r["question"]) for r in csv.DictReader(f))
+    for path in log_paths:
+        counts.update(normalize_question(q) for q in _logged_queries(path) if q)
+    counts.pop("", None)
+    return [(t, c) for t, c in counts.most_common(max_templates) if c >= min_count]
+
+
+# =========================================================
+# 📄 REPORT CONTEXTS
+# =========================================================
+
+def load_report_chunks(text_path=TEXT_PATH):
+    """Map report uid → list of its chunks (needs texts_uids.txt from embed.py)."""
+    with open(text_path, "r", encoding="utf-8") as f:
+        texts = [line.rstrip("\n") for line in f]
+    with open(uids_path_for(text_path), "r", encoding="utf-8") as f:
+        uids = [line.rstrip("\n") for line in f]
+    reports = {}
+    for uid, text in zip(uids, texts):
+        reports.setdefault(uid, []).append(text)
+    return reports
+
+
+def report_hash(chunks):
+    return hashlib.sha1("\n".join(chunks).encode("utf-8")).hexdigest()
+
+
+def current_reports(text_path=TEXT_PATH):
+    """
+    Map report uid → its current chunks, or {} when the corpus is missing or
+    texts.txt and texts_uids.txt do not line up (e.g. read while embed.py
+    was swapping them).
+    """
+    try:
+        with open(text_path, "r", encoding="utf-8") as f:
+            n_texts = sum(1 for _ in f)
+        reports = load_report_chunks(text_path)
+    except FileNotFoundError:
+        return {}
+    if sum(len(c) for c in reports.values()) != n_texts:
+        return {}
+    return reports
+
+
+def artifact_fingerprint(text_path=TEXT_PATH):
+    """Cheap change detector for the embedded corpus (size + mtime of its files)."""
+    parts = []
+    for path in (text_path, uids_path_for(text_path)):
+        try:
+            st = os.stat(path)
+            parts.append(f"{st.st_size}:{st.st_mtime_ns}")
+        except FileNotFoundError:
+            parts.append("missing")
+    return "|".join(parts)
+
+
+# =========================================================
+# 🗄️ ON-DISK TABLE
+# =========================================================
+
+def _connect(db_path):
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.execute("""CREATE TABLE IF NOT EXISTS answers (
+                        template TEXT NOT NULL,
+                        uid TEXT NOT NULL,
+                        answer TEXT NOT NULL,
+                        report_hash TEXT NOT NULL,
+                        created TEXT NOT NULL,
+                        PRIMARY KEY (template, uid)
+                    ) WITHOUT ROWID""")
+    conn.execute("CREATE INDEX IF NOT EXISTS answers_by_uid ON answers (uid)")
+    return conn
+
+
+def build_table(db_path=DB_PATH, text_path=TEXT_PATH, templates=None, batch_size=16):
+    """
+    Offline job: precompute answers for every (template, report uid) pair.
+    Answers whose report text changed are regenerated, and answers for
+    reports no longer in the corpus are pruned.
+    """
+    from src.rag import generate_answers_batch   # loads the models
+
+    templates = templates if templates is not None else [t for t, _ in mine_templates()]
+    if not templates:
+        print("⚠️ No frequent question templates found; nothing to precompute.")
+        return 0
+    print("📋 Templates:", *templates, sep="\n   ↳ ")
+
+    reports = load_report_chunks(text_path)
+    hashes = {uid: report_hash(chunks) for uid, chunks in reports.items()}
+    conn = _connect(db_path)
+    gone = [(u,) for (u,) in conn.execute("SELECT DISTINCT uid FROM answers") if u not in hashes]
+    conn.executemany("DELETE FROM answers WHERE uid = ?", gone)
+    conn.commit()
+    if gone:
+        print(f"♻️ Pruned answers of {len(gone)} reports no longer in the corpus.")
+    created = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    total = 0
+    start = time.perf_counter()
+    for template in templates:
+        # Skip pairs already answered for the current report text
+        done = {uid for uid, h in conn.execute(
+            "SELECT uid, report_hash FROM answers WHERE template = ?", (template,)) if hashes.get(uid) == h}
+        todo = [uid for uid in reports if uid not in done]
+        answers = generate_answers_batch([template] * len(todo),
+                                         [reports[uid][:CONTEXT_CHUNKS] for uid in todo],
+                                         batch_size=batch_size)
+        conn.executemany("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?)",
+                         [(template, uid, a, hashes[uid], created) for uid, a in zip(todo, answers)])
+        conn.commit()
+        total += len(todo)
+        print(f"✅ '{template}': {len(todo)} new answers ({len(done)} up to date)")
+
+    conn.close()
+    print(f"🚀 Precomputed {total} answers in {time.perf_counter() - start:.1f}s → {db_path}")
+    return total
+
+
+class AnswerTable:
+    """
+    Online, read-only lookup. The table is held in a dict for microsecond
+    lookups and reloaded when the SQLite file changes. When texts.txt /
+    texts_uids.txt change (reports re-embedded), entries whose stored
+    report_hash no longer matches the current report text are hidden, so they
+    fall back to live RAG until build_table() regenerates them. The table on
+    disk is never modified here. report_chunks(uid) gives the context a
+    precomputed answer for that report was generated from, so live answers
+    about the same report can use the same context.
+    """
+
+    def __init__(self, db_path=DB_PATH, text_path=TEXT_PATH):
+        self.db_path = db_path
+        self.text_path = text_path
+        self._rows = {}       # (template, uid) → (answer, report_hash)
+        self._reports = {}    # uid → current chunks of the report
+        self._hashes = {}     # uid → hash of the current report text
+        self._answers = {}    # rows still matching the current report text
+        self._db_mtime = None
+        self._fingerprint = None
+        self._failed_mtime = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._db_mtime is not None and now - self._checked < STALE_CHECK_SECONDS:
+            return
+        with self._lock:
+            self._checked = now
+            changed = False
+            fingerprint = artifact_fingerprint(self.text_path)
+            if fingerprint != self._fingerprint:
+                # Re-checked on every change, so a transient (mid-write) state
+                # only hides answers until the files settle
+                self._reports = current_reports(self.text_path)
+                self._hashes = {uid: report_hash(chunks) for uid, chunks in self._reports.items()}
+                self._fingerprint = fingerprint
+                changed = True
+            if not os.path.exists(self.db_path):
+                self._rows, self._answers, self._db_mtime = {}, {}, 0
+                return
+            mtime = os.stat(self.db_path).st_mtime_ns
+            if mtime != self._db_mtime:
+                try:
+                    conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+                    try:
+                        self._rows = {(t, u): (a, h) for t, u, a, h in
+                                      conn.execute("SELECT template, uid, answer, report_hash FROM answers")}
+                    finally:
+                        conn.close()
+                    self._db_mtime = mtime
+                    changed = True
+                except sqlite3.Error as e:
+                    # Retried on the next check; warn once per file version
+                    if mtime != self._failed_mtime:
+                        print(f"⚠️ Answer table not reloaded ({e}); keeping the previous one.")
+                        self._failed_mtime = mtime
+                    if self._db_mtime is None:
+                        self._db_mtime = 0
+            if changed:
+                hashes = self._hashes
+                self._answers = {key: a for key, (a, h) in self._rows.items() if hashes.get(key[1]) == h}
+                hidden = len(self._rows) - len(self._answers)
+                if hidden:
+                    print(f"♻️ {hidden} precomputed answers hidden until the table is rebuilt "
+                          f"(report text changed).")
+
+    def lookup(self, query, uid):
+        """Return the precomputed answer for (query, uid), or None."""
+        if uid is None or str(uid).strip() == "":
+            return None
+        self._refresh()
+        return self._answers.get((normalize_question(query), str(uid).strip()))
+
+    def report_chunks(self, uid):
+        """Context chunks of report uid (as used by build_table), or None if unknown."""
+        if uid is None or str(uid).strip() == "":
+            return None
+        self._refresh()
+        chunks = self._reports.get(str(uid).strip())
+        return chunks[:CONTEXT_CHUNKS] if chunks else None
+
+
+# =========================================================
+# 🧪 RUN DIRECTLY: offline batch job
+# =========================================================
+if __name__ == "__main__":
+    build_table()
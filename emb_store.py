@@ -0,0 +1,160 @@
+# src/emb_store.py
+# ==============================================
+# Purpose: Sharded, memory-mappable embedding artifact with optional
+#          float16 / int8 scalar quantization.
+#
+# Layout of a store directory:
+#   manifest.json            → dim, dtype, quantization, shard list
+#   shard_00000.npy          → (rows, dim) float32 | float16 | int8
+#   shard_00000.scale.npy    → (rows,) float32 per-row scales (int8 only)
+# ==============================================
+
+import os
+import json
+import numpy as np
+
+MANIFEST = "manifest.json"
+QUANT_MODES = ("none", "float16", "int8")
+
+# Rows per shard file (≈ 75 MB of float32 at dim=384)
+SHARD_ROWS = 50_000
+
+
+def uids_path_for(text_path):
+    """Sidecar file holding the report uid of every line in texts.txt."""
+    return os.path.splitext(text_path)[0] + "_uids.txt"
+
+
+# =========================================================
+# ✍️ WRITER
+# =========================================================
+
+class EmbeddingWriter:
+    """
+    Append embedding batches and flush them to fixed-size shards, so the full
+    matrix never has to be held in memory. Call close() to write the manifest.
+    """
+
+    def __init__(self, out_dir, quant="none", shard_rows=SHARD_ROWS):
+        if quant not in QUANT_MODES:
+            raise ValueError(f"❌ Unknown quantization '{quant}'. Choose one of {QUANT_MODES}.")
+        self.out_dir = out_dir
+        self.quant = quant
+        self.shard_rows = shard_rows
+        self.dim = None
+        self.shards = []
+        self._pending = []
+        self._pending_rows = 0
+        os.makedirs(out_dir, exist_ok=True)
+
+    def add(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        if batch.ndim != 2:
+            raise ValueError("❌ Embedding batch must be a 2-D array.")
+        if self.dim is None:
+            self.dim = batch.shape[1]
+        elif batch.shape[1] != self.dim:
+            raise ValueError(f"❌ Dimension mismatch: expected {self.dim}, got {batch.shape[1]}.")
+        self._pending.append(batch)
+        self._pending_rows += len(batch)
+        while self._pending_rows >= self.shard_rows:
+            self._flush(self.shard_rows)
+
+    def _flush(self, rows):
+        data = np.concatenate(self._pending) if len(self._pending) > 1 else self._pending[0]
+        shard, rest = data[:rows], data[rows:]
+        self._pending = [rest] if len(rest) else []
+        self._pending_rows = len(rest)
+
+        name = f"shard_{len(self.shards):05d}"
+        entry = {"file": f"{name}.npy", "rows": int(len(shard))}
+        if self.quant == "float16":
+            np.save(os.path.join(self.out_dir, entry["file"]), shard.astype(np.float16))
+        elif self.quant == "int8":
+            q, scale = quantize_int8(shard)
+            np.save(os.path.join(self.out_dir, entry["file"]), q)
+            entry["scale"] = f"{name}.scale.npy"
+            np.save(os.path.join(self.out_dir, entry["scale"]), scale)
+        else:
+            np.save(os.path.join(self.out_dir, entry["file"]), shard)
+        self.shards.append(entry)
+
+    def close(self):
+        if self._pending_rows:
+            self._flush(self._pending_rows)
+        manifest = {
+            "dim": self.dim,
+            "quant": self.quant,
+            "rows": sum(s["rows"] for s in self.shards),
+            "shards": self.shards,
+        }
+        with open(os.path.join(self.out_dir, MANIFEST), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        return manifest
+
+
+# =========================================================
+# 🔢 SCALAR QUANTIZATION
+# =========================================================
+
+def quantize_int8(x):
+    """Symmetric per-row int8 quantization. Returns (int8 codes, float32 scales)."""
+    scale = np.abs(x).max(axis=1) / 127.0
+    scale[scale == 0] = 1.0
+    q = np.clip(np.rint(x / scale[:, None]), -127, 127).astype(np.int8)
+    return q, scale.astype(np.float32)
+
+
+def dequantize_int8(q, scale):
+    return q.astype(np.float32) * scale[:, None]
+
+
+# =========================================================
+# 📖 READER
+# =========================================================
+
+def is_store(path):
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+
+def load_manifest(store_dir):
+    with open(os.path.join(store_dir, MANIFEST), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def iter_batches(store_dir, batch_rows):
+    """
+    Yield float32 batches of at most batch_rows rows, in corpus order.
+    Shards are memory-mapped, so only the current batch is materialised
+    (always as a writable copy, never a view into the read-only mapping).
+    """
+    manifest = load_manifest(store_dir)
+    for shard in manifest["shards"]:
+        data = np.load(os.path.join(store_dir, shard["file"]), mmap_mode="r")
+        scale = None
+        if "scale" in shard:
+            scale = np.load(os.path.join(store_dir, shard["scale"]), mmap_mode="r")
+        for start in range(0, shard["rows"], batch_rows):
+            block = data[start:start + batch_rows]
+            if scale is not None:
+                yield dequantize_int8(block, np.asarray(scale[start:start + batch_rows]))
+            else:
+                yield np.array(block, dtype=np.float32)
+
+
+def open_embeddings(path, batch_rows):
+    """
+    Return (rows, dim, batch iterator) for either a sharded store directory
+    or a legacy single embeddings.npy file (opened memory-mapped).
+    """
+    if is_store(path):
+        manifest = load_manifest(path)
+        return manifest["rows"], manifest["dim"], iter_batches(path, batch_rows)
+
+    data = np.load(path, mmap_mode="r")
+
+    def _legacy():
+        for start in range(0, len(data), batch_rows):
+            yield np.array(data[start:start + batch_rows], dtype=np.float32)
+
+    return data.shape[0], data.shape[1], _legacy()
@@ -6,7 +6,12 @@
 import os
 import pandas as pd
 import numpy as np
+import sys
+import math
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from sentence_transformers import SentenceTransformer
+from src.emb_store import EmbeddingWriter, SHARD_ROWS, uids_path_for
 
 # =========================================================
 # 🧩 CONFIGURATION SECTION
@@ -20,6 +25,23 @@ MODEL_NAME = "all-MiniLM-L6-v2"
 # Chunk size (number of words per chunk)
 CHUNK_SIZE = 200
 
+# Scalar quantization of the stored embeddings: "none" (float32), "float16" or "int8"
+EMB_QUANT = "none"
+
+# Chunks encoded (and held in RAM as embeddings) at a time before being
+# flushed to the sharded store
+ENCODE_WINDOW = SHARD_ROWS
+
+# Encoder processes (1 = encode in this process, on the model's device).
+# None = auto: 1 when the model runs on CUDA (a CPU pool would be slower),
+# else CPU_ENCODE_WORKERS. Each CPU worker loads its own copy of the model and
+# gets cpu_count // workers torch threads.
+ENCODE_WORKERS = None
+CPU_ENCODE_WORKERS = max(1, (os.cpu_count() or 1) // 2)
+
+# Sentences per forward pass
+ENCODE_BATCH_SIZE = 64
+
 
 # =========================================================
 # 🧠 HELPER FUNCTIONS
@@ -34,9 +56,92 @@ def chunk_text(text, max_words=CHUNK_SIZE):
         yield " ".join(words[i:i + max_words])
 
 
-def build_embeddings(clean_csv, out_emb_path, out_text_path):
+def token_lengths(model, chunks):
+    """Token count of every chunk (word count if the model exposes no tokenizer)."""
+    tokenizer = getattr(model, "tokenizer", None)
+    if tokenizer is None:
+        return [len(c.split()) for c in chunks]
+    enc = tokenizer(chunks, add_special_tokens=False, truncation=True,
+                    max_length=model.max_seq_length)
+    return [len(ids) for ids in enc["input_ids"]]
+
+
+def resolve_workers(model, workers=ENCODE_WORKERS):
+    """Number of encoder processes to use for `model` (see ENCODE_WORKERS)."""
+    if workers is None:
+        return 1 if str(model.device).startswith("cuda") else CPU_ENCODE_WORKERS
+    return workers
+
+
+def start_encode_pool(model, workers=ENCODE_WORKERS):
+    """
+    Start a sentence-transformers multi-process pool on CPU, or return None
+    for single-process encoding. Thread count is capped per worker so the
+    processes do not oversubscribe the cores.
+    """
+    workers = resolve_workers(model, workers)
+    if workers <= 1:
+        return None
+    threads = str(max(1, (os.cpu_count() or 1) // workers))
+    saved = {k: os.environ.get(k) for k in ("OMP_NUM_THREADS", "MKL_NUM_THREADS")}
+    os.environ.update({k: threads for k in saved})   # inherited by the spawned workers
+    try:
+        return model.start_multi_process_pool(target_devices=["cpu"] * workers)
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+
+def encode_chunks(model, chunks, pool=None, batch_size=ENCODE_BATCH_SIZE, show_progress_bar=True):
+    """
+    Encode chunks sorted by token length, so every batch holds chunks of similar
+    length and little padding, then restore the original chunk order.
+    With a pool, consecutive length-sorted slices are fanned out to the workers.
+    """
+    order = np.argsort(token_lengths(model, chunks), kind="stable")
+    sorted_chunks = [chunks[i] for i in order]
+
+    if pool is None:
+        emb = model.encode(sorted_chunks, batch_size=batch_size,
+                           show_progress_bar=show_progress_bar, convert_to_numpy=True)
+    else:
+        # Whole batches per slice, ~4 slices per worker for load balancing
+        n_workers = len(pool["processes"])
+        per_slice = math.ceil(len(chunks) / (n_workers * 4 * batch_size)) * batch_size
+        emb = model.encode_multi_process(sorted_chunks, pool, batch_size=batch_size,
+                                         chunk_size=max(batch_size, per_slice))
+
+    out = np.empty_like(emb)
+    out[order] = emb
+    return out
+
+
+def benchmark_encoding(chunks, worker_counts=(1, 2, 4), sample=2000):
+    """Print chunks/sec of encode_chunks for different worker counts."""
+    model = SentenceTransformer(MODEL_NAME, device="cpu")
+    chunks = chunks[:sample]
+    print(f"⏱️ Encoding benchmark on {len(chunks)} chunks ({os.cpu_count()} CPUs)")
+    for workers in worker_counts:
+        pool = start_encode_pool(model, workers)
+        try:
+            encode_chunks(model, chunks[:ENCODE_BATCH_SIZE], pool, show_progress_bar=False)  # warm-up
+            start = time.perf_counter()
+            encode_chunks(model, chunks, pool, show_progress_bar=False)
+            elapsed = time.perf_counter() - start
+        finally:
+            if pool is not None:
+                model.stop_multi_process_pool(pool)
+        print(f"   ↳ workers={workers}: {len(chunks) / elapsed:,.1f} chunks/sec ({elapsed:.1f}s)")
+
+
+def build_embeddings(clean_csv, out_emb_path, out_text_path, quant=EMB_QUANT, workers=ENCODE_WORKERS):
     """
     Load cleaned EHR data, chunk text, and create embeddings for each chunk.
+    out_emb_path is a directory holding a sharded store (see emb_store.py);
+    a path ending in .npy keeps the old single-file float32 output.
     """
     # Step 1: Load the cleaned dataset
     print(f"Loading cleaned file: {clean_csv}")
@@ -48,35 +153,66 @@ def build_embeddings(clean_csv, out_emb_path, out_text_path):
 
     # Step 3: Combine all chunks
     texts = df['combined_text'].astype(str).tolist()
+    uids = df['uid'].astype(str).tolist() if 'uid' in df.columns else [str(i) for i in range(len(df))]
     all_chunks = []
-    for t in texts:
+    chunk_uids = []
+    for uid, t in zip(uids, texts):
         for chunk in chunk_text(t):
             all_chunks.append(chunk)
+            chunk_uids.append(uid)
     print(f"✅ Total text chunks prepared: {len(all_chunks)}")
 
     # Step 4: Load SentenceTransformer model
     print(f"🧠 Loading embedding model: {MODEL_NAME}")
     model = SentenceTransformer(MODEL_NAME)
 
-    # Step 5: Encode all chunks into embeddings
-    print("⚙️ Encoding text chunks into embeddings (this may take a few minutes)...")
-    embeddings = model.encode(all_chunks, show_progress_bar=True, convert_to_numpy=True)
-
-    # Step 6: Ensure output directory exists
-    os.makedirs(os.path.dirname(out_emb_path), exist_ok=True)
-
-    # Step 7: Save embeddings as .npy
-    np.save(out_emb_path, embeddings)
+    # Step 5: Encode chunks window by window and stream them to disk
+    workers = resolve_workers(model, workers)
+    print(f"⚙️ Encoding text chunks into embeddings with {workers} worker(s) (this may take a few minutes)...")
+    legacy = out_emb_path.endswith(".npy")
+    os.makedirs(os.path.dirname(out_emb_path) if legacy else out_emb_path, exist_ok=True)
+    writer = None if legacy else EmbeddingWriter(out_emb_path, quant=quant)
+    parts = []
+    pool = start_encode_pool(model, workers)
+    start_time = time.perf_counter()
+    try:
+        for start in range(0, len(all_chunks), ENCODE_WINDOW):
+            window = all_chunks[start:start + ENCODE_WINDOW]
+            emb = encode_chunks(model, window, pool)
+            if legacy:
+                parts.append(emb)
+            else:
+                writer.add(emb)
+    finally:
+        if pool is not None:
+            model.stop_multi_process_pool(pool)
+    elapsed = time.perf_counter() - start_time
+    print(f"⏱️ Encoded {len(all_chunks)} chunks in {elapsed:.1f}s ({len(all_chunks) / max(elapsed, 1e-9):,.1f} chunks/sec)")
+
+    # Step 6: Finalise embeddings on disk
+    if legacy:
+        embeddings = np.concatenate(parts)
+        np.save(out_emb_path, embeddings)
+        shape = embeddings.shape
+    else:
+        manifest = writer.close()
+        shape = (manifest["rows"], manifest["dim"])
     print(f"✅ Embeddings saved at: {out_emb_path}")
 
-    # Step 8: Save chunked text
-    with open(out_text_path, "w", encoding="utf-8") as f:
+    # Step 7: Save chunked text. Both files are written to temporaries first and
+    # swapped in with os.replace, so readers never see a half-written file
+    uids_path = uids_path_for(out_text_path)
+    with open(out_text_path + ".tmp", "w", encoding="utf-8") as f:
         for t in all_chunks:
             f.write(t.replace("\n", " ") + "\n")
-    print(f"✅ Text chunks saved at: {out_text_path}")
-
-    # Step 9: Summary info
-    print("📊 Embeddings shape:", embeddings.shape)
+    with open(uids_path + ".tmp", "w", encoding="utf-8") as f:
+        f.write("\n".join(chunk_uids) + "\n")
+    os.replace(out_text_path + ".tmp", out_text_path)
+    os.replace(uids_path + ".tmp", uids_path)
+    print(f"✅ Text chunks saved at: {out_text_path} (report uids in {uids_path})")
+
+    # Step 8: Summary info
+    print("📊 Embeddings shape:", shape, "| quantization:", "none" if legacy else quant)
     print("📦 Total chunks encoded:", len(all_chunks))
     print("🚀 Embedding generation complete!")
 
@@ -85,8 +221,15 @@ def build_embeddings(clean_csv, out_emb_path, out_text_path):
 # 🧪 RUN DIRECTLY
 # =========================================================
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        # python embed.py bench → chunks/sec at different worker counts
+        df = pd.read_csv("../data/cleaned/indiana_reports_cleaned.csv")
+        chunks = [c for t in df['combined_text'].astype(str) for c in chunk_text(t)]
+        benchmark_encoding(chunks, worker_counts=sorted({1, 2, 4, CPU_ENCODE_WORKERS}))
+        sys.exit()
+
     build_embeddings(
         "../data/cleaned/indiana_reports_cleaned.csv",  # Correct path & filename
-        "../models/embeddings.npy",
+        "../models/embeddings",                           # sharded store directory
         "../models/texts.txt"
     )
\ No newline at end of file
@@ -7,11 +7,29 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
 smooth = SmoothingFunction().method1
 # simple token-F1 implemented manually (no sklearn tokenization needed)
-from typing import Dict
+from typing import Dict, List, Tuple, Callable
+import json
+import pickle
+import ast
+import glob
+import inspect
+import hashlib
+from statistics import NormalDist
 
-# Import your RAG functions (adjust import if your rag.py location/names differ)
+# RAG functions are imported lazily inside the stages (loading rag.py loads the
+# models); rag_config only holds names/prompt/decode settings for cache keys.
 # rag.py should expose retrieve_top_k(query, index_path, k) and generate_answer(query, retrieved_texts)
-from src.rag import retrieve_top_k, generate_answer
+from src import rag_config
+from src.answer_table import normalize_question
+
+# Stage outputs are cached here, one file per content hash of the stage inputs
+CACHE_DIR = os.path.join("results", "cache")
+RAG_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rag.py")
+SHARD_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shard_search.py")
+
+# Code each cached stage depends on (top-level functions/classes of rag.py)
+RETRIEVAL_FUNCTIONS = ("_load_index", "retrieve_top_k", "retrieve_top_k_sharded")
+GENERATION_FUNCTIONS = ("build_prompt", "clean_answer", "generate_answer")
 
 def simple_eval(generated: str, reference: str) -> Dict[str, float]:
     """
@@ -46,53 +64,351 @@ def bleu_score(generated: str, reference: str) -> float:
         score = 0.0
     return float(score)
 
-def evaluate_model(validation_csv: str, top_k: int = 3):
+# ---------------------------------
+# Cached evaluation stages
+# ---------------------------------
+def _sha(*parts) -> str:
+    """Content hash of JSON-serialisable parts."""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(json.dumps(part, sort_keys=True, default=str).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()[:20]
+
+def file_digest(path: str) -> str:
+    """Streamed sha256 of a file's contents ('missing' if it does not exist)."""
+    if not os.path.exists(path):
+        return "missing"
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def function_source(path: str, names) -> Dict[str, str]:
+    """
+    Source of the named top-level functions/classes of a module, read with
+    ast so that hashing rag.py's code does not import it (and load the models).
+    """
+    if not os.path.exists(path):
+        return {name: "missing" for name in names}
+    with open(path, "r", encoding="utf-8") as f:
+        source = f.read()
+    defs = {node.name: ast.get_source_segment(source, node) for node in ast.parse(source).body
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef))}
+    return {name: defs.get(name, "missing") for name in names}
+
+def shard_digest(shard_root: str):
+    """Digest of a shard root (manifest + every shard's files), None when not sharded."""
+    if not shard_root:
+        return None
+    files = [os.path.join(shard_root, "manifest.json")]
+    files += sorted(glob.glob(os.path.join(shard_root, "shard_*", "*")))
+    return {os.path.relpath(p, shard_root): file_digest(p) for p in files}
+
+def cached_stage(stage: str, key: str, compute: Callable, use_cache: bool = True):
+    """Load the output of `stage` for `key` from disk, or compute and store it."""
+    path = os.path.join(CACHE_DIR, stage, f"{key}.pkl")
+    if use_cache and os.path.exists(path):
+        print(f"♻️ {stage}: cache hit ({key})")
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    print(f"⚙️ {stage}: computing ({key})")
+    result = compute()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(result, f)
+    os.replace(tmp, path)
+    return result
+
+def retrieval_fingerprint() -> list:
+    """
+    Everything retrieval depends on besides the questions: embed model, index
+    and corpus contents, shard root and shard files (EHR_SHARD_ROOT, read by
+    rag.py at import) and the source of the retrieval functions. Hashes the
+    index files, so compute it once per run and pass it to retrieval_stage.
+    """
+    shard_root = os.environ.get("EHR_SHARD_ROOT")
+    return [rag_config.EMBED_MODEL_NAME,
+            file_digest(rag_config.INDEX_PATH), file_digest(rag_config.TEXT_PATH),
+            function_source(RAG_SOURCE, RETRIEVAL_FUNCTIONS),
+            shard_root, shard_digest(shard_root),
+            function_source(SHARD_SOURCE, ("ShardedRetriever",)) if shard_root else None]
+
+def generation_fingerprint() -> list:
+    """
+    Everything generation depends on besides its inputs: prompt template,
+    decode params and the source of the generation functions only (retrieval
+    edits or comments elsewhere in rag.py do not re-run generation).
+    """
+    return [rag_config.PROMPT_TEMPLATE, rag_config.decode_params(),
+            function_source(RAG_SOURCE, GENERATION_FUNCTIONS)]
+
+def retrieval_stage(questions: List[str], top_k: int, use_cache: bool = True,
+                    fingerprint: list = None) -> Tuple[str, list]:
+    """Top-k retrieval for every question. Key: questions, k and retrieval_fingerprint()."""
+    if fingerprint is None:
+        fingerprint = retrieval_fingerprint()
+    key = _sha("retrieval", questions, top_k, *fingerprint)
+
+    def compute():
+        from src.rag import retrieve_top_k
+        out = []
+        for i, question in enumerate(questions):
+            try:
+                retrieved_texts, scores = retrieve_top_k(question, k=top_k)
+            except TypeError:
+                # if your retrieve_top_k signature is different, call with only question
+                retrieved_texts, scores = retrieve_top_k(question)
+            out.append((list(retrieved_texts), [float(x) for x in scores]))
+            print(f"--- Q{i+1}: retrieved {len(retrieved_texts)} documents")
+        return out
+
+    return key, cached_stage("retrieval", key, compute, use_cache)
+
+def generation_stage(questions: List[str], retrieved: list, retrieval_key: str,
+                     use_cache: bool = True, fingerprint: list = None) -> Tuple[str, List[str]]:
+    """Answers for every question. Key: retrieval output and generation_fingerprint()."""
+    if fingerprint is None:
+        fingerprint = generation_fingerprint()
+    key = _sha("generation", retrieval_key, *fingerprint)
+
+    def compute():
+        from src.rag import generate_answer
+        out = []
+        for i, (question, (retrieved_texts, _)) in enumerate(zip(questions, retrieved)):
+            generated = generate_answer(question, retrieved_texts)
+            print(f"--- Q{i+1}: {question}\nGenerated: {generated}")
+            out.append(generated)
+        return out
+
+    return key, cached_stage("generation", key, compute, use_cache)
+
+def metric_stage(df: pd.DataFrame, generated: List[str], generation_key: str,
+                 use_cache: bool = True) -> pd.DataFrame:
+    """Per-question metrics. Key: generations, gold answers, row ids, metric function source."""
+    gold = df['gold_answer'].tolist()
+    # row_id is part of the output (baseline pairing joins on it), so it is part of the key
+    key = _sha("metrics-v2", generation_key, gold, df.index.tolist(),
+               inspect.getsource(simple_eval), inspect.getsource(bleu_score))
+
+    def compute():
+        results = []
+        for row_id, question, answer, reference in zip(df.index, df['question'], generated, gold):
+            token_metrics = simple_eval(answer, reference)
+            results.append({
+                'row_id': row_id,
+                'question': question,
+                'generated': answer,
+                'gold_answer': reference,
+                'precision': token_metrics['precision'],
+                'recall': token_metrics['recall'],
+                'f1': token_metrics['f1'],
+                'bleu': bleu_score(answer, reference)
+            })
+        return pd.DataFrame(results)
+
+    return cached_stage("metrics", key, compute, use_cache)
+
+def evaluate_model(validation_csv: str, top_k: int = 3, use_cache: bool = True,
+                   mode: str = "full", **sample_kwargs):
+    """
+    Retrieval → generation → metrics, each stage cached on disk by a content
+    hash of its inputs: a prompt/decode change only re-runs generation, a
+    metric change only re-runs scoring. use_cache=False recomputes everything.
+    mode="sample" runs the early-stopping evaluation instead (see evaluate_sampled);
+    both modes return the per-question results DataFrame.
+    """
+    if mode == "sample":
+        return evaluate_sampled(validation_csv, top_k=top_k, use_cache=use_cache, **sample_kwargs)
+    if mode != "full":
+        raise ValueError(f"Unknown evaluation mode: {mode!r} (use 'full' or 'sample')")
+
     # create results folder
     os.makedirs("results", exist_ok=True)
 
     df = pd.read_csv(validation_csv)
-    results = []
-
-    for i, row in df.iterrows():
-        question = row['question']
-        gold = row['gold_answer']
-
-        print(f"\n--- Q{i+1} ---")
-        print("Question:", question)
-        # 1) retrieve top_k docs (calls your retrieval)
-        try:
-            retrieved_texts, scores = retrieve_top_k(question, k=top_k)
-        except TypeError:
-            # if your retrieve_top_k signature is different, call with only question
-            retrieved_texts, scores = retrieve_top_k(question)
-
-        print(f"Retrieved {len(retrieved_texts)} documents (showing first 1):")
-        if len(retrieved_texts) > 0:
-            print(retrieved_texts[0][:300], "...")
-        # 2) generate answer using RAG pipeline
-        generated = generate_answer(question, retrieved_texts)
-        print("Generated:", generated)
-        print("Gold:", gold)
-
-        # 3) compute metrics
-        token_metrics = simple_eval(generated, gold)
-        bscore = bleu_score(generated, gold)
-
-        result_row = {
-            'question': question,
-            'generated': generated,
-            'gold_answer': gold,
-            'precision': token_metrics['precision'],
-            'recall': token_metrics['recall'],
-            'f1': token_metrics['f1'],
-            'bleu': bscore
-        }
-        results.append(result_row)
-
-    res_df = pd.DataFrame(results)
+    questions = df['question'].astype(str).tolist()
+
+    retrieval_key, retrieved = retrieval_stage(questions, top_k, use_cache)
+    generation_key, generated = generation_stage(questions, retrieved, retrieval_key, use_cache)
+    res_df = metric_stage(df, generated, generation_key, use_cache)
+
     out_path = os.path.join("results", "evaluation_results.csv")
     res_df.to_csv(out_path, index=False)
-    print("\nEvaluation complete. Results saved to:", out_path)
+    print(f"\nMean F1: {res_df['f1'].mean():.4f} | Mean BLEU: {res_df['bleu'].mean():.4f}")
+    print("Evaluation complete. Results saved to:", out_path)
+    return res_df
+
+# ---------------------------------
+# Sampling evaluation with early stopping
+# ---------------------------------
+def stratified_order(df: pd.DataFrame, seed: int = 0) -> List[int]:
+    """
+    Random order in which every question template appears in proportion to
+    its share of the data at any prefix (systematic interleaving of shuffled
+    per-template groups), so an early stop still sees a representative mix.
+    """
+    rng = np.random.default_rng(seed)
+    keyed = []
+    for _, group in df.groupby(df['question'].map(normalize_question), sort=False):
+        ids = rng.permutation(group.index.to_numpy())
+        slots = (np.arange(len(ids)) + rng.random(len(ids))) / len(ids)
+        keyed.extend(zip(slots, ids))
+    keyed.sort()
+    return [int(i) for _, i in keyed]
+
+def bootstrap_ci(values, n_boot: int = 1000, alpha: float = 0.05, seed: int = 0) -> Tuple[float, float, float]:
+    """(mean, lower, upper) percentile-bootstrap confidence interval of the mean."""
+    x = np.asarray(values, dtype=float)
+    if len(x) == 0:
+        return 0.0, 0.0, 0.0
+    rng = np.random.default_rng(seed)
+    means = x[rng.integers(0, len(x), size=(n_boot, len(x)))].mean(axis=1)
+    lo, hi = np.percentile(means, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+    return float(x.mean()), float(lo), float(hi)
+
+def planned_looks(n_total: int, min_questions: int, check_every: int) -> List[int]:
+    """Question counts at which the sampled evaluation checks its stopping rules."""
+    looks = list(range(min(min_questions, n_total), n_total, check_every))
+    return looks + [n_total] if not looks or looks[-1] != n_total else looks
+
+def alpha_spent(t: float, alpha: float, spending: str = "pocock") -> float:
+    """
+    Lan-DeMets alpha-spending function: cumulative two-sided type-I error
+    allowed by information fraction t (0..1). "pocock" spends early (suits
+    early stopping), "obf" (O'Brien-Fleming) keeps almost all of it for the end.
+    """
+    t = min(max(t, 0.0), 1.0)
+    if spending == "pocock":
+        return alpha * np.log(1 + (np.e - 1) * t)
+    if spending == "obf":
+        return 2 * NormalDist().cdf(NormalDist().inv_cdf(alpha / 2) / np.sqrt(t)) if t > 0 else 0.0
+    raise ValueError(f"Unknown alpha spending: {spending!r} (use 'pocock' or 'obf')")
+
+def look_alphas(looks: List[int], alpha: float, spending: str = "pocock") -> List[float]:
+    """
+    Two-sided level of each planned look: the alpha spent since the previous
+    look. The levels sum to alpha, so by the union bound the chance that any
+    look rejects a true null (or any look's interval misses) is at most alpha,
+    however the looks are correlated.
+    """
+    n_total = looks[-1]
+    spent = [alpha_spent(n / n_total, alpha, spending) for n in looks]
+    return [max(float(b - a), 0.0) for a, b in zip([0.0] + spent[:-1], spent)]
+
+def z_critical(alpha: float) -> float:
+    """Two-sided normal critical value (computed from the lower tail, so tiny alphas stay exact)."""
+    return -NormalDist().inv_cdf(alpha / 2) if alpha > 0 else float("inf")
+
+def normal_ci(values, alpha: float) -> Tuple[float, float, float]:
+    """(mean, lower, upper) two-sided normal-approximation CI of the mean at level alpha."""
+    x = np.asarray(values, dtype=float)
+    if len(x) == 0:
+        return 0.0, 0.0, 0.0
+    se = x.std(ddof=1) / np.sqrt(len(x)) if len(x) > 1 else 0.0
+    z = z_critical(alpha)
+    return float(x.mean()), float(x.mean() - z * se), float(x.mean() + z * se)
+
+def evaluate_sampled(validation_csv: str, top_k: int = 3, baseline_csv: str = None,
+                     ci_width: float = 0.02, alpha: float = 0.05, min_questions: int = 100,
+                     max_questions: int = None, check_every: int = 25, n_boot: int = 1000,
+                     spending: str = "pocock", seed: int = 0, use_cache: bool = True) -> pd.DataFrame:
+    """
+    Evaluate questions in stratified random order, in blocks of check_every
+    (each block goes through the cached retrieval/generation/metric stages),
+    and stop as soon as the answer is known:
+      - without a baseline: when the bootstrap CIs of mean F1 and BLEU are
+        both narrower than ci_width;
+      - with baseline_csv (a previous results CSV with row_id, f1, bleu): when
+        the paired F1 or BLEU difference is significant, or both difference
+        CIs are narrower than ci_width (no change beyond noise).
+    The baseline comparison is a group-sequential test over the planned looks
+    (min_questions, then every check_every questions, up to max_questions or
+    the whole set): alpha is split between F1 and BLEU, then spread over the
+    looks with an alpha-spending function (see look_alphas), so repeated
+    checking does not inflate false "significant" results.
+    Writes per-question results and a JSON summary (incl. questions used and
+    the corrected alpha); returns the results DataFrame like full mode, with
+    the summary in res_df.attrs["summary"].
+    """
+    os.makedirs("results", exist_ok=True)
+    df = pd.read_csv(validation_csv)
+    order = stratified_order(df, seed)
+    if max_questions:
+        order = order[:max_questions]
+    looks = planned_looks(len(order), min_questions, check_every)
+    metric_names = ("f1", "bleu")
+    alpha_metric = alpha / len(metric_names)
+    alphas = look_alphas(looks, alpha_metric, spending)
+
+    baseline = None
+    if baseline_csv:
+        baseline = pd.read_csv(baseline_csv).set_index('row_id')[['f1', 'bleu']]
+
+    # Corpus/index/code fingerprints are hashed once per run, not once per block
+    retrieval_fp, generation_fp = retrieval_fingerprint(), generation_fingerprint()
+
+    blocks, summary = [], {}
+    stop_reason = "exhausted"
+    done = 0
+    for look, (n, alpha_look) in enumerate(zip(looks, alphas), start=1):
+        block = df.loc[order[done:n]]
+        questions = block['question'].astype(str).tolist()
+        retrieval_key, retrieved = retrieval_stage(questions, top_k, use_cache, retrieval_fp)
+        generation_key, generated = generation_stage(questions, retrieved, retrieval_key, use_cache,
+                                                     generation_fp)
+        blocks.append(metric_stage(block, generated, generation_key, use_cache))
+        done = n
+
+        res = pd.concat(blocks, ignore_index=True)
+        summary = {m: dict(zip(("mean", "lower", "upper"), bootstrap_ci(res[m], n_boot, alpha, seed)))
+                   for m in metric_names}
+        widths = {m: summary[m]["upper"] - summary[m]["lower"] for m in metric_names}
+        line = f"[{n}/{len(order)}] " + " | ".join(
+            f"{m.upper()} {summary[m]['mean']:.4f} [{summary[m]['lower']:.4f}, {summary[m]['upper']:.4f}]"
+            for m in metric_names)
+
+        if baseline is None:
+            print(line)
+            if all(w <= ci_width for w in widths.values()):
+                stop_reason = f"CI width <= {ci_width}"
+                break
+            continue
+
+        paired = res.join(baseline, on='row_id', rsuffix='_base', how='inner')
+        for m in metric_names:
+            # Round away float noise from the baseline's CSV round-trip
+            delta = (paired[m] - paired[f"{m}_base"]).round(9)
+            mean, lo, hi = normal_ci(delta, alpha_look)
+            summary[f"{m}_diff"] = {"mean": mean, "lower": lo, "upper": hi, "paired": len(paired)}
+        summary["look"] = {"index": look, "of": len(looks), "alpha": alpha_look,
+                           "z_critical": z_critical(alpha_look)}
+        diff = {m: summary[f"{m}_diff"] for m in metric_names}
+        print(line + f" | Δ (look {look}/{len(looks)}, α={alpha_look:.2e}) " + " ".join(
+            f"{m.upper()} {d['mean']:+.4f} [{d['lower']:+.4f}, {d['upper']:+.4f}]" for m, d in diff.items()))
+        if len(paired) < min_questions or alpha_look <= 0:
+            continue
+        significant = [m for m, d in diff.items() if d["lower"] > 0 or d["upper"] < 0]
+        if significant:
+            stop_reason = "significant difference in " + ", ".join(significant)
+            break
+        if all(d["upper"] - d["lower"] <= ci_width for d in diff.values()):
+            stop_reason = f"no difference beyond ±{ci_width / 2} (difference CI width <= {ci_width})"
+            break
+
+    res_df = pd.concat(blocks, ignore_index=True) if blocks else pd.DataFrame()
+    summary.update({"questions_used": len(res_df), "questions_total": len(df),
+                    "stop_reason": stop_reason, "alpha": alpha, "alpha_per_metric": alpha_metric,
+                    "spending": spending, "looks_planned": len(looks),
+                    "ci_width": ci_width, "baseline": baseline_csv, "seed": seed})
+    res_df.to_csv(os.path.join("results", "sampled_evaluation_results.csv"), index=False)
+    with open(os.path.join("results", "sampled_evaluation_summary.json"), "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+    print(f"\nStopped after {len(res_df)}/{len(df)} questions: {stop_reason}")
+    print("Summary saved to: results/sampled_evaluation_summary.json")
+    res_df.attrs["summary"] = summary
     return res_df
 
 if __name__ == "__main__":
@@ -100,4 +416,9 @@ if __name__ == "__main__":
     val_csv = "data/validation_questions.csv"
     if not os.path.exists(val_csv):
         raise FileNotFoundError(f"Validation file not found: {val_csv}")
-    evaluate_model(val_csv, top_k=3)
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "sample":
+        # python eval.py sample [baseline_results.csv]
+        baseline = sys.argv[2] if len(sys.argv) > 2 else None
+        evaluate_model(val_csv, top_k=3, mode="sample", baseline_csv=baseline)
+    else:
+        evaluate_model(val_csv, top_k=3)
\ No newline at end of file
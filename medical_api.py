@@ -1,28 +1,33 @@
 # src/medical_api.py
 
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from serpapi import GoogleSearch
+from src.keyword_matcher import KeywordTable
+
+# Dictionary tables (CSV or JSON); edits are picked up without a restart
+TABLE_DIR = os.path.dirname(os.path.abspath(__file__))
+symptom_drugs = KeywordTable(os.path.join(TABLE_DIR, "symptom_drugs.csv"), key="symptom",
+                             columns=("drug",))
+drug_stores = KeywordTable(os.path.join(TABLE_DIR, "drug_stores.csv"), key="drug",
+                           columns=("store", "address"))
 
 # Function to recommend medicine based on the query
-def recommend_medicine(query):
-    # Simple example of how medicine recommendation could work based on query
-    if "headache" in query.lower():
-        return "Recommended Medicine: Panadol (Paracetamol) for headache relief."
-    elif "fever" in query.lower():
-        return "Recommended Medicine: Ibuprofen for fever relief."
-    elif "cough" in query.lower():
-        return "Recommended Medicine: Dextromethorphan for cough relief."
-    else:
+def recommend_medicine(query, limit=3):
+    # Every symptom mentioned in the query is found in one pass; best-ranked drugs first
+    rows = symptom_drugs.lookup(query, limit=limit)
+    if not rows:
         return "No specific medicine found for the given query."
+    return "\n".join(f"Recommended Medicine: {r['drug']} for {r['symptom']} relief." for r in rows)
 
 # Function to find the nearest pharmacy store (based on query)
-def find_nearby_store(query):
-    # Simple example of how store finding could work based on the query (e.g., medicine name)
-    if "Panadol" in query:
-        return "Nearest store for Panadol: ABC Pharmacy, 123 Main Street."
-    elif "Ibuprofen" in query:
-        return "Nearest store for Ibuprofen: XYZ Pharmacy, 456 Elm Street."
-    else:
+def find_nearby_store(query, limit=3):
+    # Query is typically a medicine name (or a recommend_medicine answer)
+    rows = drug_stores.lookup(query, limit=limit)
+    if not rows:
         return "No store found for the given query."
+    return "\n".join(f"Nearest store for {r['drug']}: {r['store']}, {r['address']}." for r in rows)
 
 # Function to fetch medical data from GME Plus or similar service (you can implement your logic here)
 def get_gmeplus_data(query):
@@ -0,0 +1,276 @@
+# src/metrics.py
+# ==============================================
+# Purpose: Lightweight latency / counter instrumentation for the RAG pipeline.
+#          Per-stage timing spans, HDR-style histograms, a Prometheus text
+#          exporter and optional sampled cProfile dumps of slow requests.
+# ==============================================
+
+import os
+import time
+import random
+import threading
+import cProfile
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# =========================================================
+# 🧩 CONFIGURATION SECTION
+# =========================================================
+
+# Set EHR_METRICS=0 to turn every span/counter into a no-op
+ENABLED = os.environ.get("EHR_METRICS", "1") != "0"
+
+# Local port for the /metrics endpoint (Prometheus text format)
+METRICS_PORT = int(os.environ.get("EHR_METRICS_PORT", "9108"))
+
+# Fraction of requests run under cProfile (0.0 = never)
+PROFILE_SAMPLE_RATE = float(os.environ.get("EHR_PROFILE_SAMPLE", "0.0"))
+
+# Sampled requests slower than this are dumped to PROFILE_DIR
+PROFILE_SLOW_MS = float(os.environ.get("EHR_PROFILE_SLOW_MS", "2000"))
+PROFILE_DIR = os.environ.get("EHR_PROFILE_DIR", "logs/profiles")
+
+# Quantiles exported for every latency histogram
+EXPORT_QUANTILES = (0.5, 0.9, 0.95, 0.99)
+
+
+# =========================================================
+# 📊 HDR-STYLE LATENCY HISTOGRAM
+# =========================================================
+
+class LatencyHistogram:
+    """
+    Log-linear histogram of latencies in microseconds (HdrHistogram layout).
+    Values below 2**sub_bucket_bits are exact; above that every power of two
+    is split into 2**(sub_bucket_bits-1) linear buckets, so the relative error
+    stays below 1 / 2**(sub_bucket_bits-1) (~0.8% with the default of 8 bits).
+    Recording is O(1) and the memory footprint is fixed.
+    """
+
+    def __init__(self, sub_bucket_bits=8, max_shift=40):
+        self.sub_bits = sub_bucket_bits
+        self.sub_count = 1 << sub_bucket_bits
+        self.half = self.sub_count // 2
+        self.max_shift = max_shift
+        self.counts = [0] * (self.sub_count + max_shift * self.half)
+        self.total = 0
+        self.sum_us = 0
+        self.max_us = 0
+        self._lock = threading.Lock()
+
+    def _index(self, v):
+        if v < self.sub_count:
+            return v
+        shift = min(v.bit_length() - self.sub_bits, self.max_shift)
+        sub = min(v >> shift, self.sub_count - 1)
+        return self.sub_count + (shift - 1) * self.half + (sub - self.half)
+
+    def _value_at(self, idx):
+        """Upper edge (in µs) of the bucket at idx."""
+        if idx < self.sub_count:
+            return idx
+        shift = (idx - self.sub_count) // self.half + 1
+        sub = (idx - self.sub_count) % self.half + self.half
+        return ((sub + 1) << shift) - 1
+
+    def record(self, value_us):
+        v = max(0, int(value_us))
+        idx = self._index(v)
+        with self._lock:
+            self.counts[idx] += 1
+            self.total += 1
+            self.sum_us += v
+            if v > self.max_us:
+                self.max_us = v
+
+    def percentile(self, q):
+        """Return the q-quantile (0..1) in microseconds."""
+        with self._lock:
+            if self.total == 0:
+                return 0
+            target = max(1, int(q * self.total + 0.5))
+            seen = 0
+            for idx, c in enumerate(self.counts):
+                if c:
+                    seen += c
+                    if seen >= target:
+                        return min(self._value_at(idx), self.max_us)
+            return self.max_us
+
+    def snapshot(self):
+        """Return (count, sum_seconds, {quantile: seconds})."""
+        quantiles = {q: self.percentile(q) / 1e6 for q in EXPORT_QUANTILES}
+        with self._lock:
+            return self.total, self.sum_us / 1e6, quantiles
+
+
+# =========================================================
+# 🧮 REGISTRY (counters + histograms)
+# =========================================================
+
+_registry_lock = threading.Lock()
+_histograms = {}   # stage name -> LatencyHistogram
+_counters = {}     # (name, ((label, value), ...)) -> int
+
+
+def _histogram(stage):
+    h = _histograms.get(stage)
+    if h is None:
+        with _registry_lock:
+            h = _histograms.setdefault(stage, LatencyHistogram())
+    return h
+
+
+def observe(stage, seconds):
+    """Record one latency sample (in seconds) for a pipeline stage."""
+    if ENABLED:
+        _histogram(stage).record(seconds * 1e6)
+
+
+def inc(name, value=1, **labels):
+    """Increment a counter, e.g. inc("ehr_index_cache_total", result="hit")."""
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _registry_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+@contextmanager
+def span(stage):
+    """Time the enclosed block and record it under the given stage name."""
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        _histogram(stage).record((time.perf_counter_ns() - start) / 1000)
+
+
+def percentile(stage, q):
+    """Convenience accessor: q-quantile of a stage in seconds (0 if unseen)."""
+    h = _histograms.get(stage)
+    return h.percentile(q) / 1e6 if h else 0.0
+
+
+def reset():
+    """Drop every recorded sample (mainly for benchmarks)."""
+    with _registry_lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+# =========================================================
+# 📤 PROMETHEUS TEXT EXPORTER
+# =========================================================
+
+def _fmt_labels(pairs):
+    if not pairs:
+        return ""
+    body = ",".join(f'{k}="{str(v).replace(chr(34), "")}"' for k, v in pairs)
+    return "{" + body + "}"
+
+
+def render_prometheus():
+    """Render all metrics in the Prometheus text exposition format."""
+    lines = [
+        "# HELP ehr_stage_latency_seconds Latency of each RAG pipeline stage.",
+        "# TYPE ehr_stage_latency_seconds summary",
+    ]
+    for stage in sorted(_histograms):
+        count, total, quantiles = _histograms[stage].snapshot()
+        for q, v in quantiles.items():
+            lines.append(f'ehr_stage_latency_seconds{{stage="{stage}",quantile="{q}"}} {v:.6f}')
+        lines.append(f'ehr_stage_latency_seconds_sum{{stage="{stage}"}} {total:.6f}')
+        lines.append(f'ehr_stage_latency_seconds_count{{stage="{stage}"}} {count}')
+
+    with _registry_lock:
+        counters = sorted(_counters.items())
+    typed = set()
+    for (name, labels), value in counters:
+        if name not in typed:
+            lines.append(f"# TYPE {name} counter")
+            typed.add(name)
+        lines.append(f"{name}{_fmt_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") not in ("/metrics", ""):
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep scrapes out of the Streamlit console
+        pass
+
+
+_server = None
+
+
+def start_metrics_server(port=None, host="127.0.0.1"):
+    """
+    Serve /metrics on a daemon thread. Safe to call repeatedly (Streamlit
+    re-runs the script on every interaction); only the first call binds.
+    """
+    global _server
+    if _server is not None or not ENABLED:
+        return _server
+    port = METRICS_PORT if port is None else port
+    try:
+        _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        print(f"⚠️ Metrics endpoint not started on {host}:{port}: {e}")
+        return None
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+    print(f"[INFO] Metrics available at http://{host}:{port}/metrics")
+    return _server
+
+
+# =========================================================
+# 🐢 SAMPLED PROFILING OF SLOW REQUESTS
+# =========================================================
+
+@contextmanager
+def profiled(name):
+    """
+    Run a sampled fraction of requests under cProfile and dump the stats of
+    the slow ones to PROFILE_DIR as .prof files (open with snakeviz or pstats).
+    Unsampled requests only pay for a random() call. For whole-process
+    flamegraphs attach py-spy to the running pid instead.
+    """
+    if not ENABLED or PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler is already active in this thread
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        inc("ehr_profiled_requests_total", name=name)
+        if elapsed_ms >= PROFILE_SLOW_MS:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            stamp = time.strftime("%Y%m%d-%H%M%S")
+            out = os.path.join(PROFILE_DIR, f"{name}-{stamp}-{int(elapsed_ms)}ms.prof")
+            profiler.dump_stats(out)
+            inc("ehr_slow_profiles_total", name=name)
+            print(f"[INFO] Slow request profile saved: {out}")
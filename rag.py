@@ -3,11 +3,16 @@ import faiss
 import numpy as np
 import torch
 import gc
+import time
 import sys, os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from sentence_transformers import SentenceTransformer
 from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
 from src.logger import init_log, add_log
+from src import metrics
+from src.rag_config import (EMBED_MODEL_NAME, GEN_MODEL_NAME, TEXT_PATH, INDEX_PATH,
+                            PROMPT_TEMPLATE, DOC_CHARS, MAX_INPUT_LENGTH, MAX_ANSWER_LENGTH,
+                            NUM_BEAMS, REPETITION_PENALTY, TEMPERATURE, TOP_P)
 
 # ---------------------------------
 # 1️⃣ Load Models
@@ -15,13 +20,11 @@ from src.logger import init_log, add_log
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 print("[INFO] Models loaded successfully on:", device)
 
-# ✅ Use BioBERT for retrieval embeddings (medical domain)
-embed_model = SentenceTransformer("gsarti/biobert-nli")
+# ✅ Model names live in src/rag_config.py
+embed_model = SentenceTransformer(EMBED_MODEL_NAME)
 
-# ✅ Use a stronger generator model for reasoning (Flan-T5-Large)
-# If your system is slow, change to "google/flan-t5-base"
-tokenizer = AutoTokenizer.from_pretrained("google/flan-t5-small")
-gen_model = AutoModelForSeq2SeqLM.from_pretrained("google/flan-t5-small")
+tokenizer = AutoTokenizer.from_pretrained(GEN_MODEL_NAME)
+gen_model = AutoModelForSeq2SeqLM.from_pretrained(GEN_MODEL_NAME)
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 # ✅ Convert to half precision if GPU is available
@@ -35,7 +38,7 @@ print("[INFO] Models loaded successfully on:", device)
 # 2️⃣ Load Text Corpus
 # ---------------------------------
 try:
-    with open("models/texts.txt", "r", encoding="utf-8") as f:
+    with open(TEXT_PATH, "r", encoding="utf-8") as f:
         docs = [line.strip() for line in f.readlines() if line.strip()]
     print(f"[INFO] Loaded {len(docs)} documents for retrieval.")
 except FileNotFoundError:
@@ -45,75 +48,146 @@ except FileNotFoundError:
 # ---------------------------------
 # 3️⃣ Retrieve Similar Documents
 # ---------------------------------
-def retrieve_top_k(query, index_path="models/faiss.index", k=3):
-    with torch.no_grad():
-        q_emb = embed_model.encode([query], convert_to_numpy=True)
+# Set EHR_SHARD_ROOT (e.g. models/shards, built by src/shard_search.py) to
+# serve retrieval from sharded worker processes instead of one index
+SHARD_ROOT = os.environ.get("EHR_SHARD_ROOT")
+_sharded = None
+
+# Loaded FAISS indexes, keyed by path (avoids re-reading the file on every query)
+_index_cache = {}
+
+def _load_index(index_path):
+    index = _index_cache.get(index_path)
+    if index is not None:
+        metrics.inc("ehr_index_cache_total", result="hit")
+        return index
+    metrics.inc("ehr_index_cache_total", result="miss")
+    with metrics.span("retrieve.read_index"):
+        index = faiss.read_index(index_path)
+    _index_cache[index_path] = index
+    return index
+
+def retrieve_top_k_sharded(query, k=3):
+    """Scatter the query to every shard worker and merge their top-k."""
+    global _sharded
+    if _sharded is None:
+        from src.shard_search import ShardedRetriever
+        _sharded = ShardedRetriever(SHARD_ROOT).start()
+    with metrics.span("retrieve.total"):
+        with metrics.span("retrieve.encode"), torch.no_grad():
+            q_emb = embed_model.encode([query], convert_to_numpy=True)
+        with metrics.span("retrieve.scatter_gather"):
+            faiss.normalize_L2(q_emb)
+            retrieved, scores, _ = _sharded.search(q_emb, k)
+        if _sharded.last_missing:
+            metrics.inc("ehr_shard_timeouts_total", value=len(_sharded.last_missing))
+    return retrieved, scores
+
+def retrieve_top_k(query, index_path=INDEX_PATH, k=3):
     """Retrieve top-k most similar docs from FAISS index."""
-    index = faiss.read_index(index_path)
-    faiss.normalize_L2(q_emb)
-    D, I = index.search(q_emb, k)
-    retrieved = [docs[i] for i in I[0]]
+    if SHARD_ROOT:
+        return retrieve_top_k_sharded(query, k=k)
+    with metrics.span("retrieve.total"):
+        with metrics.span("retrieve.encode"), torch.no_grad():
+            q_emb = embed_model.encode([query], convert_to_numpy=True)
+        index = _load_index(index_path)
+        with metrics.span("retrieve.search"):
+            faiss.normalize_L2(q_emb)
+            D, I = index.search(q_emb, k)
+        retrieved = [docs[i] for i in I[0]]
     return retrieved, D[0]
 
 # ---------------------------------
 # 4️⃣ Generate Answer
 # ---------------------------------
-def generate_answer(query, retrieved_texts):
-    """Generate factual answer using retrieved EHR context."""
+# Prompt template and decoding settings: see src/rag_config.py
+def build_prompt(query, retrieved_texts):
     # Limit doc length to avoid truncation
-    short_docs = [t[:600] for t in retrieved_texts]
+    short_docs = [t[:DOC_CHARS] for t in retrieved_texts]
     context = "\n\n".join(short_docs)
-
-        # ✅ Improved prompt for better instruction following
-    prompt = f"""
-You are an expert radiology assistant.
-Read the following clinical report carefully and answer the question in one short, factual medical sentence.
-Do not copy full sentences from the report.
-If the answer is not clearly mentioned, say exactly:
-"Information not found in the provided records."
-
---- Clinical Report ---
-{context}
------------------------
-
-Question: {query}
-
-Answer (concise and factual):
-"""
+    return PROMPT_TEMPLATE.format(context=context, query=query)
+
+def clean_answer(decoded):
+    """Post-process a decoded answer: first sentence, no repeated words."""
+    decoded = decoded.strip()
+    # Post-process to limit overly long answers or repetitions
+    decoded = decoded.split(". ")[0].strip()
+    decoded = " ".join(dict.fromkeys(decoded.split()))  # remove exact repeated words
+    decoded = decoded.replace("normal normal", "normal")
+
+    # ✅ Handle "None" or blank results
+    if not decoded or decoded.lower() in ["none", "not found"]:
+        decoded = "Not enough information in report."
+        metrics.inc("ehr_generate_empty_total")
+    return decoded
+
+def generate_answer(query, retrieved_texts, num_beams=NUM_BEAMS, max_length=MAX_ANSWER_LENGTH,
+                    max_input_length=MAX_INPUT_LENGTH):
+    """
+    Generate factual answer using retrieved EHR context.
+    Decode settings default to full quality; the load scheduler
+    (src/scheduler.py) lowers them under load.
+    """
+    start = time.perf_counter()
+    prompt = build_prompt(query, retrieved_texts)
     try:
-        with torch.no_grad():     # ✅ added
+        with metrics.span("generate.tokenize"), torch.no_grad():     # ✅ added
             inputs = tokenizer(
             prompt,
             return_tensors="pt",
             truncation=True,
-            max_length=512,
+            max_length=max_input_length,
         ).to(device)
 
-        outputs = gen_model.generate(
-            **inputs,
-            max_length=100,
-            num_beams=2,
-            repetition_penalty=2.0,
-            temperature=0.7,
-            top_p=0.9,
-        )
+        with metrics.span("generate.beam_search" if num_beams > 1 else "generate.greedy"), torch.no_grad():
+            outputs = gen_model.generate(
+                **inputs,
+                max_length=max_length,
+                num_beams=num_beams,
+                repetition_penalty=REPETITION_PENALTY,
+                temperature=TEMPERATURE,
+                top_p=TOP_P,
+            )
 
-        decoded = tokenizer.decode(outputs[0], skip_special_tokens=True).strip()
-        # Post-process to limit overly long answers or repetitions
-        decoded = decoded.split(". ")[0].strip()
-        decoded = " ".join(dict.fromkeys(decoded.split()))  # remove exact repeated words
-        decoded = decoded.replace("normal normal", "normal")
-
-        # ✅ Handle "None" or blank results
-        if not decoded or decoded.lower() in ["none", "not found"]:
-            decoded = "Not enough information in report."
-
-        return decoded
+        with metrics.span("generate.decode"):
+            return clean_answer(tokenizer.decode(outputs[0], skip_special_tokens=True))
 
     except Exception as e:
         print("❌ Generation error:", e)
+        metrics.inc("ehr_generate_errors_total")
         return "Error during generation."
 
+    finally:
+        metrics.observe("generate.total", time.perf_counter() - start)
+
+def generate_answers_batch(queries, retrieved_lists, batch_size=16, num_beams=NUM_BEAMS,
+                           max_length=MAX_ANSWER_LENGTH):
+    """
+    Offline batched variant of generate_answer: one padded forward pass per
+    batch of (query, retrieved_texts) pairs. Returns answers in input order.
+    """
+    answers = []
+    for start in range(0, len(queries), batch_size):
+        prompts = [build_prompt(q, r) for q, r in
+                   zip(queries[start:start + batch_size], retrieved_lists[start:start + batch_size])]
+        try:
+            with torch.no_grad():
+                inputs = tokenizer(prompts, return_tensors="pt", padding=True,
+                                   truncation=True, max_length=MAX_INPUT_LENGTH).to(device)
+                outputs = gen_model.generate(
+                    **inputs,
+                    max_length=max_length,
+                    num_beams=num_beams,
+                    repetition_penalty=REPETITION_PENALTY,
+                    temperature=TEMPERATURE,
+                    top_p=TOP_P,
+                )
+            answers.extend(clean_answer(t) for t in tokenizer.batch_decode(outputs, skip_special_tokens=True))
+        except Exception as e:
+            print("❌ Batch generation error:", e)
+            answers.extend(["Error during generation."] * len(prompts))
+    return answers
+
 # ---------------------------------
 # 5️⃣ Main Test Run + Evaluation
 # ---------------------------------
@@ -213,8 +287,8 @@ if __name__ == "__main__":
         generated_answer = generate_answer(q, retrieved)
 
         # Evaluation
-        metrics = simple_eval(generated_answer, ref)
-        f1 = metrics['f1']
+        eval_scores = simple_eval(generated_answer, ref)   # not `metrics`: that is the src.metrics module
+        f1 = eval_scores['f1']
         bleu = bleu_score(generated_answer, ref)
 
         print("[INFO] Final Answer:", generated_answer)
@@ -0,0 +1,58 @@
+# src/rag_config.py
+# ==============================================
+# Purpose: Model names, paths, prompt and decoding settings of the RAG
+#          pipeline, kept free of heavy imports so tools such as eval.py can
+#          fingerprint the configuration without loading the models.
+# ==============================================
+
+# ✅ Use BioBERT for retrieval embeddings (medical domain)
+EMBED_MODEL_NAME = "gsarti/biobert-nli"
+
+# ✅ Use a stronger generator model for reasoning (Flan-T5-Large)
+# If your system is slow, change to "google/flan-t5-base"
+GEN_MODEL_NAME = "google/flan-t5-small"
+
+TEXT_PATH = "models/texts.txt"
+INDEX_PATH = "models/faiss.index"
+
+# ✅ Improved prompt for better instruction following
+PROMPT_TEMPLATE = """
+You are an expert radiology assistant.
+Read the following clinical report carefully and answer the question in one short, factual medical sentence.
+Do not copy full sentences from the report.
+If the answer is not clearly mentioned, say exactly:
+"Information not found in the provided records."
+
+--- Clinical Report ---
+{context}
+-----------------------
+
+Question: {query}
+
+Answer (concise and factual):
+"""
+
+# Characters kept from each retrieved document in the prompt
+DOC_CHARS = 600
+
+# Decoding settings (full-quality defaults; see scheduler.py for degraded tiers)
+MAX_INPUT_LENGTH = 512
+MAX_ANSWER_LENGTH = 100
+NUM_BEAMS = 2
+REPETITION_PENALTY = 2.0
+TEMPERATURE = 0.7
+TOP_P = 0.9
+
+
+def decode_params():
+    """All settings that influence a generated answer (used as a cache key)."""
+    return {
+        "gen_model": GEN_MODEL_NAME,
+        "doc_chars": DOC_CHARS,
+        "max_input_length": MAX_INPUT_LENGTH,
+        "max_answer_length": MAX_ANSWER_LENGTH,
+        "num_beams": NUM_BEAMS,
+        "repetition_penalty": REPETITION_PENALTY,
+        "temperature": TEMPERATURE,
+        "top_p": TOP_P,
+    }
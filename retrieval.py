@@ -1,37 +1,157 @@
 import numpy as np
 import faiss
 import os
+import sys
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.emb_store import open_embeddings
 
 # Paths
-emb_path = "models/embeddings.npy"
+emb_path = "models/embeddings"            # sharded store (falls back to models/embeddings.npy)
+legacy_emb_path = "models/embeddings.npy"
 text_path = "models/texts.txt"
 index_path = "models/faiss.index"
 
-# --- Step 1: Check if embeddings exist ---
-if not os.path.exists(emb_path):
-    print("❌ Embedding file not found. Please run `python -m src.embed` first.")
-    exit()
+# Working-memory ceiling for streaming embeddings into FAISS (the index itself
+# still holds rows * dim * 4 bytes for a flat index, less for "fp16"/"sq8")
+MAX_BUILD_MEMORY_MB = 256
 
-print("📦 Loading embeddings and texts...")
+# Upper bound on rows used to train the "fp16"/"sq8" scalar quantizers
+MAX_TRAIN_ROWS = 100_000
 
-# --- Step 2: Load embeddings and text chunks ---
-embeddings = np.load(emb_path)
-with open(text_path, "r", encoding="utf-8") as f:
-    texts = [line.strip() for line in f.readlines()]
 
-d = embeddings.shape[1]  # embedding dimension
-print(f"📏 Embedding dimension detected: {d}")
+def _make_index(d, index_type):
+    if index_type == "flat":
+        return faiss.IndexFlatL2(d)
+    if index_type == "fp16":
+        return faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_L2)
+    if index_type == "sq8":
+        return faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_L2)
+    raise ValueError(f"❌ Unknown index type '{index_type}'. Use 'flat', 'fp16' or 'sq8'.")
 
-# --- Step 3: Create FAISS index ---
-index = faiss.IndexFlatL2(d)
-index.add(embeddings)
 
-# --- Step 4: Save index ---
-os.makedirs("models", exist_ok=True)
-faiss.write_index(index, index_path)
+def pick_rows(total, n, seed=0, exclude=None):
+    """Sorted ids of n rows drawn uniformly from range(total), minus `exclude`."""
+    candidates = np.arange(total) if exclude is None else np.setdiff1d(np.arange(total), exclude)
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(candidates, size=min(n, len(candidates)), replace=False))
 
-# --- Step 5: Verification printout ---
-print("✅ FAISS index created successfully!")
-print(f"✅ Total text chunks indexed: {len(texts)}")
-print(f"✅ Index saved at: {index_path}")
-print("🚀 Retrieval index ready to use.")
\ No newline at end of file
+
+def read_rows(source, ids, batch_rows=4096):
+    """Rows `ids` (sorted) of a store in a single streaming pass, as contiguous float32."""
+    _, _, batches = open_embeddings(source, batch_rows)
+    rows, offset = [], 0
+    for batch in batches:
+        sel = ids[(ids >= offset) & (ids < offset + len(batch))] - offset
+        if len(sel):
+            rows.append(batch[sel])
+        offset += len(batch)
+    return np.ascontiguousarray(np.concatenate(rows))
+
+
+def sample_rows(source, n, seed=0, exclude=None, batch_rows=4096):
+    """
+    Draw n rows uniformly at random across the whole store (all shards),
+    skipping the row ids in `exclude`. Returns a contiguous float32 (n, dim) array.
+    """
+    total, _, _ = open_embeddings(source, batch_rows)
+    return read_rows(source, pick_rows(total, n, seed, exclude), batch_rows)
+
+
+def build_index(source, out_path=None, index_type="flat", max_memory_mb=MAX_BUILD_MEMORY_MB,
+                skip_rows=None):
+    """
+    Stream embeddings from a sharded store (or legacy .npy) into a FAISS index
+    in fixed-size batches, printing progress and an ETA. Row ids in skip_rows
+    (sorted) are left out, e.g. to hold queries out of the index.
+    Returns the index; also writes it to out_path when given.
+    """
+    # Each batch is materialised once as float32 and once inside faiss.add
+    _, d, _ = open_embeddings(source, 1)
+    batch_rows = max(1, (max_memory_mb * 1024 * 1024) // (d * 4 * 2))
+    total, d, batches = open_embeddings(source, batch_rows)
+    print(f"📏 Embedding dimension detected: {d} | rows: {total} | batch: {batch_rows} rows")
+
+    index = _make_index(d, index_type)
+    if not index.is_trained:
+        # Scalar quantizers learn per-dimension value ranges, so train them on a
+        # sample drawn across every shard rather than on the corpus prefix
+        n_train = min(total, MAX_TRAIN_ROWS, batch_rows)
+        print(f"🎲 Training {index_type} quantizer on {n_train} sampled rows...")
+        index.train(sample_rows(source, n_train, exclude=skip_rows))
+
+    done = 0
+    start = time.perf_counter()
+    for batch in batches:
+        if skip_rows is not None:
+            skip = skip_rows[(skip_rows >= done) & (skip_rows < done + len(batch))] - done
+            keep = np.setdiff1d(np.arange(len(batch)), skip)
+            if len(keep):
+                index.add(np.ascontiguousarray(batch[keep]))
+        else:
+            index.add(batch)
+        done += len(batch)
+        elapsed = time.perf_counter() - start
+        rate = done / elapsed if elapsed > 0 else 0.0
+        eta = (total - done) / rate if rate > 0 else 0.0
+        print(f"   ↳ {done}/{total} rows ({100 * done / max(total, 1):.1f}%) "
+              f"| {rate:,.0f} rows/s | ETA {eta:.1f}s", flush=True)
+
+    if out_path:
+        os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+        faiss.write_index(index, out_path)
+    return index
+
+
+def measure_tolerance(source, reference, k=10, n_queries=200, index_type="flat", seed=0,
+                      queries=None):
+    """
+    Compare retrieval from a (quantized) store against a float32 reference;
+    reports recall@k and top-1 agreement of the candidate index against the
+    exact reference results.
+    Queries must not be in the indexes (a corpus row is its own nearest
+    neighbour, which makes agreement trivially high): pass held-out query
+    embeddings, e.g. the encoded validation questions, or by default
+    n_queries sampled rows are held out of both indexes and used as queries.
+    """
+    if queries is not None:
+        held_out = None
+        q = np.array(queries, dtype=np.float32)
+    else:
+        total, _, _ = open_embeddings(reference, 1)
+        held_out = pick_rows(total, n_queries, seed)
+        q = read_rows(reference, held_out)
+    faiss.normalize_L2(q)
+
+    ref_index = build_index(reference, index_type="flat", skip_rows=held_out)
+    cand_index = build_index(source, index_type=index_type, skip_rows=held_out)
+
+    _, I_ref = ref_index.search(q, k)
+    _, I_cand = cand_index.search(q, k)
+    recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(I_ref, I_cand)])
+    top1 = float(np.mean(I_ref[:, 0] == I_cand[:, 0]))
+    print(f"🎯 recall@{k}: {recall:.4f} | top-1 agreement: {top1:.4f} over {len(q)} queries")
+    return {"recall_at_k": float(recall), "top1_agreement": top1, "queries": int(len(q)),
+            "query_source": "given" if held_out is None else "held-out rows"}
+
+
+if __name__ == "__main__":
+    # --- Step 1: Check if embeddings exist ---
+    if not os.path.exists(emb_path):
+        emb_path = legacy_emb_path
+    if not os.path.exists(emb_path):
+        print("❌ Embedding file not found. Please run `python -m src.embed` first.")
+        exit()
+
+    print("📦 Streaming embeddings into FAISS...")
+    with open(text_path, "r", encoding="utf-8") as f:
+        n_texts = sum(1 for _ in f)
+
+    # --- Step 2-4: Create FAISS index batch by batch and save it ---
+    index = build_index(emb_path, index_path)
+
+    # --- Step 5: Verification printout ---
+    print("✅ FAISS index created successfully!")
+    print(f"✅ Total text chunks indexed: {n_texts}")
+    print(f"✅ Index saved at: {index_path}")
+    print("🚀 Retrieval index ready to use.")
@@ -0,0 +1,238 @@
+# src/scheduler.py
+# ==============================================
+# Purpose: Load-adaptive admission and degradation for answer generation.
+#          Tracks queue depth and recent latency, and serves each request at
+#          a quality tier (full → reduced → short → retrieval-only) that
+#          steps down as load rises and back up as it falls.
+# ==============================================
+
+import os
+import sys
+import time
+import random
+import threading
+from collections import deque, namedtuple, Counter
+from contextlib import contextmanager
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src import metrics
+from src.rag_config import NUM_BEAMS, MAX_ANSWER_LENGTH, MAX_INPUT_LENGTH
+
+# =========================================================
+# 🧩 CONFIGURATION SECTION
+# =========================================================
+
+# Latency budget per request (seconds) the scheduler tries to keep the p95 under
+TARGET_P95 = 3.0
+
+# Generations allowed to run at once; further requests wait in the queue
+MAX_CONCURRENCY = 2
+
+# Number of recent requests the p95 is computed over
+LATENCY_WINDOW = 50
+
+# Minimum seconds between two latency-driven tier changes (hysteresis)
+TIER_COOLDOWN = 5.0
+
+# k = max documents (None = keep the user's k), num_beams = 0 → no generation
+Tier = namedtuple("Tier", ["name", "k", "num_beams", "max_length", "max_input_length"])
+
+TIERS = [
+    Tier("full", None, NUM_BEAMS, MAX_ANSWER_LENGTH, MAX_INPUT_LENGTH),   # default RAG settings
+    Tier("reduced", 2, 1, 100, 512),         # fewer docs, greedy decoding
+    Tier("short", 1, 1, 32, 256),            # one doc, short prompt and answer
+    Tier("retrieval_only", 1, 0, 0, 0),      # best matching report excerpt, no generation
+]
+
+
+# =========================================================
+# 🚦 SCHEDULER
+# =========================================================
+
+class LoadAdaptiveScheduler:
+    """
+    Every request is admitted at a tier chosen from two signals:
+      - queue depth (waiting + running): beyond MAX_CONCURRENCY each extra
+        batch of MAX_CONCURRENCY requests forces one tier lower, immediately;
+      - recent p95 latency: above the target the base tier steps down, below
+        half the target it steps back up (at most once per TIER_COOLDOWN).
+    """
+
+    def __init__(self, target_p95=TARGET_P95, max_concurrency=MAX_CONCURRENCY,
+                 window=LATENCY_WINDOW, cooldown=TIER_COOLDOWN, tiers=TIERS):
+        self.target_p95 = target_p95
+        self.max_concurrency = max_concurrency
+        self.cooldown = cooldown
+        self.tiers = tiers
+        self.level = 0
+        self.depth = 0
+        self._latencies = deque(maxlen=window)
+        self._last_change = 0.0
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(max_concurrency)
+
+    def recent_p95(self):
+        with self._lock:
+            values = sorted(self._latencies)
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(0.95 * len(values)))]
+
+    def _adjust_level(self, now, p95):
+        # Called with self._lock held
+        if now - self._last_change < self.cooldown or len(self._latencies) < 5:
+            return
+        if p95 > self.target_p95 and self.level < len(self.tiers) - 1:
+            self.level += 1
+            self._last_change = now
+        elif p95 < 0.5 * self.target_p95 and self.level > 0:
+            self.level -= 1
+            self._last_change = now
+
+    def _choose_tier(self, depth):
+        p95 = self.recent_p95()
+        with self._lock:
+            self._adjust_level(time.monotonic(), p95)
+            level = self.level
+        overload = depth - self.max_concurrency
+        floor = 0 if overload <= 0 else 1 + (overload - 1) // self.max_concurrency
+        return self.tiers[min(len(self.tiers) - 1, max(level, floor))]
+
+    @contextmanager
+    def request(self):
+        """
+        Admit one request. Yields a Request whose .tier is fixed for its
+        lifetime; the latency of the block is recorded when it exits, so wrap
+        only the work the tiers control (generation on the tier's documents),
+        not retrieval, external API fallbacks or rendering.
+        """
+        start = time.monotonic()
+        with self._lock:
+            self.depth += 1
+            depth = self.depth
+        tier = self._choose_tier(depth)
+        req = Request(self, tier)
+        metrics.inc("ehr_requests_by_tier_total", tier=tier.name)
+        try:
+            yield req
+        finally:
+            latency = time.monotonic() - start
+            with self._lock:
+                self.depth -= 1
+                self._latencies.append(latency)
+            metrics.observe(f"request.tier.{tier.name}", latency)
+            req.latency = latency
+            req.queue_depth = depth
+
+    def serve(self, query, k, retrieve_fn, generate_fn):
+        """
+        Retrieve + answer in one call, with the same admission scope as the
+        Streamlit app: retrieval runs at the user's k outside the scheduler,
+        only generation is admitted (on the tier's k documents).
+        Returns (answer, retrieved, scores, tier_name).
+        """
+        retrieved, scores = retrieve_fn(query, k=k)
+        with self.request() as req:
+            n = req.k(k)
+            retrieved, scores = retrieved[:n], scores[:n]
+            answer = req.answer(query, retrieved, generate_fn)
+        return answer, retrieved, scores, req.tier.name
+
+
+class Request:
+    """Handle for one admitted request, bound to its tier."""
+
+    def __init__(self, scheduler, tier):
+        self.scheduler = scheduler
+        self.tier = tier
+        self.latency = None
+        self.queue_depth = None
+
+    def k(self, requested_k):
+        return requested_k if self.tier.k is None else min(requested_k, self.tier.k)
+
+    def answer(self, query, retrieved, generate_fn):
+        if self.tier.num_beams == 0:
+            return retrieval_only_answer(retrieved)
+        # Wait for a generation slot; this is where queueing happens
+        with self.scheduler._slots:
+            return generate_fn(query, retrieved,
+                               num_beams=self.tier.num_beams,
+                               max_length=self.tier.max_length,
+                               max_input_length=self.tier.max_input_length)
+
+
+def retrieval_only_answer(retrieved):
+    """Cheapest tier: the first sentence of the best matching report chunk."""
+    if not retrieved:
+        return "Information not found in the provided records."
+    first = retrieved[0].split(". ")[0].strip().rstrip(".")
+    return f"{first}. (retrieval-only answer, system under high load)"
+
+
+# =========================================================
+# 🧪 RUN DIRECTLY: local load generator
+# =========================================================
+
+def run_load_test(scheduler, serve_fn, rate, duration, seed=0):
+    """
+    Open-loop load: requests arrive as a Poisson process of `rate` per second
+    for `duration` seconds, each on its own thread (arrivals do not wait for
+    earlier answers, like users at different workstations).
+    Returns (p95 latency, requests, Counter of tiers).
+    """
+    rng = random.Random(seed)
+    latencies, tiers = [], Counter()
+    lock = threading.Lock()
+
+    def one_request():
+        start = time.monotonic()
+        tier = serve_fn(scheduler)
+        with lock:
+            latencies.append(time.monotonic() - start)
+            tiers[tier] += 1
+
+    threads = []
+    stop_at = time.monotonic() + duration
+    while time.monotonic() < stop_at:
+        t = threading.Thread(target=one_request)
+        t.start()
+        threads.append(t)
+        time.sleep(rng.expovariate(rate))
+    for t in threads:
+        t.join()
+    latencies.sort()
+    p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))] if latencies else 0.0
+    return p95, len(latencies), tiers
+
+
+if __name__ == "__main__":
+    # Simulated pipeline so the scheduler can be exercised without the models.
+    # Service times (seconds) roughly follow Flan-T5-small on CPU; pass
+    # "real" to drive the actual RAG pipeline instead.
+    COST = {"full": 1.2, "reduced": 0.6, "short": 0.3}
+
+    if len(sys.argv) > 1 and sys.argv[1] == "real":
+        from src.rag import retrieve_top_k, generate_answer
+    else:
+        def retrieve_top_k(query, k=3):
+            time.sleep(0.02)
+            return ["There is no focal consolidation. Heart size is normal."] * k, [0.5] * k
+
+        def generate_answer(query, retrieved, num_beams=2, max_length=100, max_input_length=512):
+            tier = "full" if num_beams > 1 else ("reduced" if max_length > 32 else "short")
+            time.sleep(COST[tier])
+            return "Heart size is normal."
+
+    def serve(scheduler):
+        return scheduler.serve("Is the heart size normal?", 3, retrieve_top_k, generate_answer)[3]
+
+    duration = 30
+    print(f"🎯 Target p95: {TARGET_P95}s | {MAX_CONCURRENCY} generation slots | {duration}s per load level")
+    for rate in (0.5, 1.0, 2.0, 4.0, 8.0):
+        for label, tiers in (("fixed", TIERS[:1]), ("adaptive", TIERS)):
+            sched = LoadAdaptiveScheduler(tiers=tiers)
+            p95, n, served = run_load_test(sched, serve, rate, duration)
+            ok = "✅" if p95 <= TARGET_P95 else "❌"
+            mix = ", ".join(f"{t}={c}" for t, c in served.most_common())
+            print(f"{ok} {rate:>4} req/s {label:<8} p95={p95:6.2f}s requests={n:>4} tiers: {mix}")
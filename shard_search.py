@@ -0,0 +1,372 @@
+# src/shard_search.py
+# ==============================================
+# Purpose: Sharded scatter-gather retrieval.
+#          The corpus is split into N FAISS shards (by report uid hash or a
+#          custom partition key); each shard is served by its own worker
+#          process (`python src/shard_search.py serve ...`, which never
+#          imports the RAG models), and a coordinator fans a query out to
+#          every shard over an authenticated local connection and merges the
+#          top-k.
+#
+# Layout of a shard root:
+#   manifest.json              → n_shards, metric, partition key
+#   shard_000/faiss.index      → vectors of this shard
+#   shard_000/ids.npy          → global row id (line in texts.txt) per vector
+#   shard_000/texts.txt        → chunk text per vector
+# ==============================================
+
+import os
+import sys
+import json
+import time
+import zlib
+import heapq
+import shutil
+import tempfile
+import itertools
+import threading
+import subprocess
+from multiprocessing.connection import Client, Listener, wait
+
+import numpy as np
+import faiss
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.emb_store import open_embeddings, uids_path_for
+
+SHARD_ROOT = "models/shards"
+MANIFEST = "manifest.json"
+
+# Seconds the coordinator waits for all shards before answering without the slow ones
+SHARD_TIMEOUT = 2.0
+
+# Seconds a (re)started worker gets to load its shard before it is given up on
+READY_TIMEOUT = 60.0
+
+
+
+# =========================================================
+# 🧱 BUILD SHARDS
+# =========================================================
+
+def shard_of(key, n_shards):
+    """Stable shard assignment (crc32, so it does not change between runs)."""
+    return zlib.crc32(str(key).encode("utf-8")) % n_shards
+
+
+def build_shards(emb_source, text_path, n_shards, out_root=SHARD_ROOT, key_fn=None,
+                 batch_rows=8192):
+    """
+    Partition the corpus into n_shards FAISS indexes.
+    By default chunks are routed by the hash of their report uid, so all chunks
+    of one report live on the same shard. Pass key_fn(uid) -> key to partition
+    by something else (e.g. a uid → study date lookup).
+    """
+    with open(text_path, "r", encoding="utf-8") as f:
+        texts = [line.rstrip("\n") for line in f]
+    uid_file = uids_path_for(text_path)
+    if os.path.exists(uid_file):
+        with open(uid_file, "r", encoding="utf-8") as f:
+            uids = [line.rstrip("\n") for line in f]
+    else:
+        print(f"⚠️ {uid_file} not found, partitioning by chunk position instead of report uid.")
+        uids = [str(i) for i in range(len(texts))]
+
+    total, d, batches = open_embeddings(emb_source, batch_rows)
+    if total != len(texts):
+        raise ValueError(f"❌ {total} embeddings but {len(texts)} text chunks. Re-run the embedding step.")
+
+    keys = [key_fn(u) if key_fn else u for u in uids]
+    assign = np.array([shard_of(k, n_shards) for k in keys])
+    indexes = [faiss.IndexFlatL2(d) for _ in range(n_shards)]
+
+    offset = 0
+    for batch in batches:
+        part = assign[offset:offset + len(batch)]
+        for s in range(n_shards):
+            rows = np.flatnonzero(part == s)
+            if len(rows):
+                indexes[s].add(np.ascontiguousarray(batch[rows]))
+        offset += len(batch)
+
+    for s in range(n_shards):
+        shard_dir = os.path.join(out_root, f"shard_{s:03d}")
+        os.makedirs(shard_dir, exist_ok=True)
+        ids = np.flatnonzero(assign == s)
+        faiss.write_index(indexes[s], os.path.join(shard_dir, "faiss.index"))
+        np.save(os.path.join(shard_dir, "ids.npy"), ids)
+        with open(os.path.join(shard_dir, "texts.txt"), "w", encoding="utf-8") as f:
+            for i in ids:
+                f.write(texts[i] + "\n")
+        print(f"   ↳ shard {s}: {len(ids)} chunks")
+
+    manifest = {"n_shards": n_shards, "metric": "l2", "partition": "custom" if key_fn else "uid"}
+    with open(os.path.join(out_root, MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"✅ {n_shards} shards written to {out_root}")
+    return manifest
+
+
+# =========================================================
+# 🛰️ SHARD WORKER (one process per shard)
+# =========================================================
+
+def _exit_when_orphaned(parent_pid, interval=1.0):
+    while os.getppid() == parent_pid:
+        time.sleep(interval)
+    os._exit(1)
+
+
+def _shard_worker(shard_dir, address, authkey, parent_pid):
+    """
+    Entry point of a worker process. Loads the shard, then listens on
+    `address` for the coordinator; runs in a fresh interpreter started from
+    this file, so the parent's __main__ (e.g. src.rag) is never re-imported.
+    """
+    # Do not linger if the coordinator exits before connecting (it may only
+    # connect on its next query, so there is no fixed accept deadline)
+    threading.Thread(target=_exit_when_orphaned, args=(parent_pid,), daemon=True).start()
+    index = faiss.read_index(os.path.join(shard_dir, "faiss.index"))
+    ids = np.load(os.path.join(shard_dir, "ids.npy"))
+    with open(os.path.join(shard_dir, "texts.txt"), "r", encoding="utf-8") as f:
+        texts = [line.rstrip("\n") for line in f]
+
+    with Listener(address, authkey=authkey) as listener:
+        conn = listener.accept()
+    conn.send(("ready", index.ntotal))
+
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            break
+        if msg is None:
+            break
+        req_id, q_emb, k = msg
+        try:
+            D, I = index.search(q_emb, min(k, max(index.ntotal, 1)))
+            hits = [(float(dist), int(ids[i]), texts[i]) for dist, i in zip(D[0], I[0]) if i >= 0]
+            conn.send((req_id, hits))
+        except Exception as e:
+            conn.send((req_id, e))
+    conn.close()
+
+
+# =========================================================
+# 🧭 COORDINATOR
+# =========================================================
+
+class ShardedRetriever:
+    """
+    Scatter a query embedding to every shard worker and gather the merged
+    top-k. Shards that do not answer within `timeout` seconds are skipped for
+    that query (their late replies are discarded); dead workers are restarted
+    in the background and skipped until they have reloaded their shard.
+    """
+
+    def __init__(self, shard_root=SHARD_ROOT, timeout=SHARD_TIMEOUT, ready_timeout=READY_TIMEOUT):
+        with open(os.path.join(shard_root, MANIFEST), "r", encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        self.shard_root = shard_root
+        self.timeout = timeout
+        self.ready_timeout = ready_timeout
+        self._authkey = os.urandom(32)
+        self._sock_dir = tempfile.mkdtemp(prefix="ehr-shards-")
+        self._req_ids = itertools.count()
+        self._launches = itertools.count()
+        self._workers = [None] * self.manifest["n_shards"]
+        self._loading = {}   # shard → (process, address, ready deadline) of a restarting worker
+        self.last_missing = []
+
+    def _address(self, s):
+        # Unique per launch: a worker killed while listening can leave its socket file behind
+        n = next(self._launches)
+        if sys.platform == "win32":
+            return rf"\\.\pipe\ehr-shard-{os.getpid()}-{s}-{n}"
+        return os.path.join(self._sock_dir, f"shard_{s:03d}_{n}.sock")
+
+    def _launch(self, s):
+        """Start the worker process of shard s; returns (process, address)."""
+        shard_dir = os.path.join(self.shard_root, f"shard_{s:03d}")
+        address = self._address(s)
+        env = dict(os.environ, EHR_SHARD_AUTHKEY=self._authkey.hex())
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "serve", shard_dir, address,
+                                 str(os.getpid())],
+                                env=env)
+        self._workers[s] = (proc, None)
+        return proc, address
+
+    def _try_connect(self, s, proc, address):
+        """
+        One connection attempt to a launched worker. Returns the connection once
+        the worker has loaded its index and is listening, else None.
+        """
+        if proc.poll() is not None:
+            raise RuntimeError(f"❌ Shard {s} worker exited with code {proc.returncode} "
+                               f"while loading its index.")
+        try:
+            conn = Client(address, authkey=self._authkey)
+        except OSError:
+            return None   # still loading
+        try:
+            conn.recv()   # ("ready", ntotal), sent right after accept
+        except EOFError:
+            raise RuntimeError(f"❌ Shard {s} worker died before reporting ready.")
+        self._workers[s] = (proc, conn)
+        return conn
+
+    def start(self, ready_timeout=None):
+        """Launch all shard workers and wait until each has loaded its index."""
+        ready_timeout = self.ready_timeout if ready_timeout is None else ready_timeout
+        launched = [self._launch(s) for s in range(len(self._workers))]
+        deadline = time.monotonic() + ready_timeout
+        try:
+            for s, (proc, address) in enumerate(launched):
+                while self._try_connect(s, proc, address) is None:
+                    if time.monotonic() >= deadline:
+                        raise TimeoutError(f"❌ Shard {s} did not come up within {ready_timeout}s.")
+                    time.sleep(0.05)
+        except (RuntimeError, TimeoutError):
+            self.close()
+            raise
+        print(f"[INFO] {len(launched)} shard workers ready.")
+        return self
+
+    def _restart(self, s):
+        proc, address = self._launch(s)
+        self._loading[s] = (proc, address, time.monotonic() + self.ready_timeout)
+
+    def _conn(self, s):
+        """
+        Connection to shard s, or None while it is unavailable. A dead worker is
+        relaunched in the background and skipped until it reports ready; it is
+        only given up on (and relaunched again) after ready_timeout.
+        """
+        if s in self._loading:
+            proc, address, deadline = self._loading[s]
+            try:
+                conn = self._try_connect(s, proc, address)
+            except RuntimeError as e:
+                print(f"⚠️ {e} Restarting it.")
+                self._restart(s)
+                return None
+            if conn is not None:
+                del self._loading[s]
+                print(f"[INFO] Shard {s} worker is back.")
+                return conn
+            if time.monotonic() >= deadline:
+                print(f"⚠️ Shard {s} did not come up within {self.ready_timeout}s, restarting it.")
+                proc.kill()
+                self._restart(s)
+            return None
+
+        worker = self._workers[s]
+        if worker is None or worker[1] is None or worker[0].poll() is not None:
+            print(f"⚠️ Shard {s} worker is down, restarting it in the background.")
+            if worker is not None and worker[0].poll() is None:
+                worker[0].kill()   # connected earlier but its connection broke
+            self._restart(s)
+            return None
+        return worker[1]
+
+    def search(self, q_emb, k=3):
+        """Return (texts, scores, global_ids) of the merged top-k (ascending L2 distance)."""
+        req_id = next(self._req_ids)
+        q_emb = np.ascontiguousarray(q_emb, dtype=np.float32)
+        pending = {}
+        for s in range(len(self._workers)):
+            conn = self._conn(s)
+            if conn is None:
+                continue
+            try:
+                conn.send((req_id, q_emb, k))
+                pending[conn] = s
+            except (BrokenPipeError, OSError):
+                self._workers[s] = (self._workers[s][0], None)   # restarted on the next query
+
+        hits = []
+        answered = set()
+        deadline = time.monotonic() + self.timeout
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            for conn in wait(list(pending), timeout=remaining):
+                try:
+                    reply_id, payload = conn.recv()
+                except EOFError:
+                    s = pending.pop(conn)
+                    self._workers[s] = (self._workers[s][0], None)
+                    continue
+                if reply_id != req_id:
+                    continue   # late answer to an earlier, timed-out query
+                s = pending.pop(conn)
+                answered.add(s)
+                if isinstance(payload, Exception):
+                    print(f"⚠️ Shard {s} search failed: {payload}")
+                    continue
+                hits.extend(payload)
+
+        self.last_missing = sorted(set(range(len(self._workers))) - answered)
+        if self.last_missing:
+            print(f"⚠️ Shards {self.last_missing} did not answer; answering from the rest.")
+
+        top = heapq.nsmallest(k, hits, key=lambda h: h[0])
+        return [t for _, _, t in top], np.array([d for d, _, _ in top], dtype=np.float32), [g for _, g, _ in top]
+
+    def close(self):
+        self._loading.clear()
+        for worker in self._workers:
+            if worker is None:
+                continue
+            proc, conn = worker
+            if conn is None:
+                proc.terminate()   # never connected or already broken
+            else:
+                try:
+                    conn.send(None)
+                except (BrokenPipeError, OSError):
+                    pass
+            try:
+                proc.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                proc.terminate()
+        self._workers = [None] * len(self._workers)
+        shutil.rmtree(self._sock_dir, ignore_errors=True)
+
+
+# =========================================================
+# 🧪 RUN DIRECTLY: build shards and check against a single index
+# =========================================================
+if __name__ == "__main__" and sys.argv[1:2] == ["serve"]:
+    # Worker process launched by ShardedRetriever: serve <shard_dir> <address> <coordinator pid>
+    _shard_worker(sys.argv[2], sys.argv[3], bytes.fromhex(os.environ.pop("EHR_SHARD_AUTHKEY")),
+                  int(sys.argv[4]))
+
+elif __name__ == "__main__":
+    n_shards = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    emb_path = "models/embeddings" if os.path.exists("models/embeddings") else "models/embeddings.npy"
+    build_shards(emb_path, "models/texts.txt", n_shards)
+
+    # Sharded top-k must match the single flat index exactly
+    total, d, batches = open_embeddings(emb_path, 4096)
+    full = faiss.IndexFlatL2(d)
+    for batch in batches:
+        full.add(batch)
+    queries = next(open_embeddings(emb_path, 50)[2])
+    faiss.normalize_L2(queries)
+
+    retriever = ShardedRetriever().start()
+    try:
+        agree = 0
+        elapsed = 0.0
+        for q in queries:
+            start = time.perf_counter()
+            _, _, gids = retriever.search(q[None, :], k=5)
+            elapsed += time.perf_counter() - start
+            _, I = full.search(q[None, :], 5)
+            agree += int(list(I[0]) == gids)
+        per_query = elapsed / len(queries) * 1000
+        print(f"🎯 {agree}/{len(queries)} queries identical to the single index | {per_query:.2f} ms/query")
+    finally:
+        retriever.close()
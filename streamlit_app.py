@@ -8,6 +8,9 @@ import streamlit as st
 import time
 from src.medical_api import get_gmeplus_data, recommend_medicine, find_nearby_store
 from src.rag import retrieve_top_k, generate_answer
+from src import metrics
+from src.scheduler import LoadAdaptiveScheduler
+from src.answer_table import AnswerTable
 # Attempt to import Google Search API function; provide a graceful fallback if the module is missing.
 try:
     from src.medical_api import get_google_answer  # Importing the Google Search API function
@@ -24,6 +27,23 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Local Prometheus endpoint (binds once per process, see src/metrics.py)
+metrics.start_metrics_server()
+
+# One scheduler shared by every session, so it sees the whole load
+@st.cache_resource
+def get_scheduler():
+    return LoadAdaptiveScheduler()
+
+scheduler = get_scheduler()
+
+# Precomputed answers for frequent questions (built by `python -m src.answer_table`)
+@st.cache_resource
+def get_answer_table():
+    return AnswerTable()
+
+answer_table = get_answer_table()
+
 # ------------------- Custom CSS Styling -------------------
 st.markdown("""
     <style>
@@ -68,6 +88,7 @@ mode = st.sidebar.radio("Response Mode", ["Hybrid (Default)", "Dataset Only", "A
 
 threshold = st.sidebar.slider("Dataset similarity threshold", 0.0, 1.0, 0.4)
 k = st.sidebar.slider("Top K Documents", 1, 10, 3)
+report_uid = st.sidebar.text_input("Report UID (optional)", help="Answer from this report's text only; frequent questions are answered instantly.")
 st.sidebar.info("Developed by Abrar Khan & Muhammad Ibrar — FYP Project")
 
 # ------------------- Header -------------------
@@ -96,16 +117,23 @@ def get_api_answer(query):
 
         # First try Wikipedia summary API
         url = f"https://en.wikipedia.org/api/rest_v1/page/summary/{topic}"
-        res = requests.get(url, timeout=5)
+        with metrics.span("api.wikipedia"):
+            res = requests.get(url, timeout=5)
         if res.status_code == 200:
             data = res.json()
             if "extract" in data and data["extract"]:
+                metrics.inc("ehr_api_answers_total", source="wikipedia")
                 return f"📘 Source: Wikipedia\n\n{data['extract']}"
 
         # If still nothing found, try Google Search API fallback
-        return get_google_answer(query)  # Use Google Search API for detailed response
+        with metrics.span("api.google"):
+            answer = get_google_answer(query)  # Use Google Search API for detailed response
+        # Counted only once it returned, so a failure is counted under "error" alone
+        metrics.inc("ehr_api_answers_total", source="google")
+        return answer
 
     except Exception as e:
+        metrics.inc("ehr_api_answers_total", source="error")
         return f"API Error: {e}"
 
 def add_log(query, retrieved_docs, generated_answer):
@@ -154,25 +182,56 @@ if st.button("🔍 Get Answer"):
     else:
         # 🌀 Show spinner during processing
         with st.spinner("🔍 Processing your question... please wait..."):
-            # Retrieve from dataset
-            retrieved, scores = retrieve_top_k(query, k=k)
-
-            if mode != "API Only":
-                st.markdown("### 📄 Retrieved Context (from EHR Dataset)")
-                for i, doc in enumerate(retrieved):
-                    st.write(f"**Doc {i+1} (score {scores[i]:.3f})**")
-                    st.write(doc[:400] + "...")
-                    st.divider()
-
-            # Decision logic to use API or Dataset response
-            use_api = (mode == "API Only") or (len(scores) == 0 or max(scores) < threshold)
-
-            if use_api:
-                st.markdown("### 🌐 External API Response")
-                answer = get_api_answer(query)  # Fetch answer from API (Google or Wikipedia)
-            else:
+            # Frequent question about a specific report → precomputed answer table
+            precomputed = answer_table.lookup(query, report_uid) if mode != "API Only" else None
+            if precomputed is not None:
+                metrics.inc("ehr_answers_total", route="precomputed")
+                retrieved = []
                 st.markdown("### 💡 EHR-based Answer")
-                answer = generate_answer(query, retrieved)  # Use EHR dataset-based response
+                st.caption(f"⚡ Precomputed answer for report {report_uid.strip()}.")
+                answer = precomputed
+            else:
+                # Time/profile only the work, not the typing animation below
+                with metrics.profiled("answer"), metrics.span("request.total"):
+                    # A Report UID scopes the context to that report (the same chunks its
+                    # precomputed answers were generated from), hit or miss
+                    report_chunks = answer_table.report_chunks(report_uid) if mode != "API Only" else None
+                    if report_chunks:
+                        retrieved, scores = report_chunks[:k], None
+                    else:
+                        if report_uid.strip() and mode != "API Only":
+                            st.warning(f"Report UID '{report_uid.strip()}' not found; searching all reports.")
+                        # Retrieve from dataset
+                        retrieved, scores = retrieve_top_k(query, k=k)
+
+                    if mode != "API Only":
+                        if scores is None:
+                            st.markdown(f"### 📄 Context (report {report_uid.strip()})")
+                        else:
+                            st.markdown("### 📄 Retrieved Context (from EHR Dataset)")
+                        for i, doc in enumerate(retrieved):
+                            st.write(f"**Doc {i+1}**" if scores is None else f"**Doc {i+1} (score {scores[i]:.3f})**")
+                            st.write(doc[:400] + "...")
+                            st.divider()
+
+                    # Decision logic to use API or Dataset response (a chosen report is always answered from its text)
+                    use_api = (mode == "API Only") or (scores is not None and (len(scores) == 0 or max(scores) < threshold))
+
+                    # Fallback rate = ehr_answers_total{route="api"} / sum(ehr_answers_total)
+                    metrics.inc("ehr_answers_total", route="api" if use_api else "dataset")
+                    if use_api:
+                        st.markdown("### 🌐 External API Response")
+                        with metrics.span("api.total"):
+                            answer = get_api_answer(query)  # Fetch answer from API (Google or Wikipedia)
+                    else:
+                        st.markdown("### 💡 EHR-based Answer")
+                        # Only generation is admitted by the scheduler, so slow external
+                        # APIs and page rendering never count towards its latency window
+                        with scheduler.request() as req:
+                            retrieved = retrieved[:req.k(k)]  # fewer documents under load
+                            answer = req.answer(query, retrieved, generate_answer)  # Use EHR dataset-based response
+                        if req.tier.name != "full":
+                            st.caption(f"⚡ High load: answered at the '{req.tier.name}' quality tier.")
 
             # 💬 Typing animation (like ChatGPT)
             placeholder = st.empty()